@@ -3,73 +3,207 @@
 #   Author:     Colin Merkel
 #   Date:       April 24 2019
 
-import subprocess
-import json
 import os
+import signal
 import sys
+import tempfile
 
+import builds
+import jobs
 import parse
+import results
+import roots
+import stats
 
-def finish(output):
-    sys.stdout.write(json.dumps(output))
-    sys.exit(0)
-
-def error(reason):
-    finish({ "message": reason, "quickfix": [] })
-
-def transform_relative_path(file_path):
-    return parse.transform_relative_path(file_path, BAZEL_DIR, CWD)
-
-try:
-    COMMAND = sys.argv[1]
-    FILE = sys.argv[2]
-    CWD = sys.argv[3]
-# Sometimes not enough parameters are passed in, which means that the
-# user tried to run `cargo build` on an empty buffer, or something
-# like that.
-except IndexError:
-    error("Can't find WORKSPACE, is this a bazel project?")
-
-# Find the root directory of the project, where Cargo.toml is located.
-BAZEL_DIR = os.path.dirname(CWD + "/" + FILE)
-while not os.path.isfile(BAZEL_DIR + "/WORKSPACE"):
-    parent_directory = os.path.dirname(BAZEL_DIR)
-    # Make sure we haven't reached the top level directory.
-    if parent_directory == BAZEL_DIR:
-        error("Can't find WORKSPACE, is this a cargo project?")
-    BAZEL_DIR = parent_directory
-
-
-try:
+# run runs blaze.sh for `file_path` and returns the result for vim. See
+# cargo.run for `emit` and `options`.
+def run(command, file_path, cwd, emit=None, job=None, options=None):
+    options = options or {}
+    recorder = stats.start(options)
+    # See cargo.run for `tests`. bazel knows which test targets the file
+    # belongs to, so only the path of the tests inside it is used.
+    tests = options.get("tests") if command == "test" else None
+    test_filter = None
+    files = options.get("files") or [os.path.join(cwd, file_path)]
+    if tests is not None:
+        test_filter = "::".join(tests.get("path", []))
+
+    # bazel only runs one command at a time in a workspace, so all the
+    # files in a workspace are passed to a single blaze.sh. Separate
+    # workspaces are built in parallel.
+    workspaces = {}
+    with recorder.phase("roots"):
+        if tests is not None:
+            files = [os.path.join(cwd, file_path)]
+        elif files == "git":
+            files = [f for f in roots.modified_files(cwd) if f.endswith(".rs")]
+
+        for f in files:
+            bazel_dir = roots.find_bazel_dir(os.path.dirname(f))
+            if bazel_dir is None:
+                continue
+            workspaces.setdefault(bazel_dir, []).append(os.path.relpath(f, bazel_dir))
+
+    if not workspaces:
+        return results.result("Can't find WORKSPACE, is this a bazel project?")
+
+    # See cargo.run. A targeted run only has the one file.
+    test_target = None
+    if tests is not None:
+        bazel_dir, sources = list(workspaces.items())[0]
+        test_target = " ".join([bazel_dir] + sources)
+
+    if job is None:
+        job = jobs.Job()
+    collector = results.Collector(
+        "bazel:%s:%s:%s" % (",".join(sorted(workspaces)), cwd, command),
+        options,
+        emit,
+        recorder
+    )
+
+    def add(batch):
+        if test_target is not None:
+            parse.set_test_target(batch, test_target)
+        collector.add(batch)
     local_dir = os.path.dirname(os.path.realpath(__file__))
-    command  = ' '.join(["%s/blaze.sh" % local_dir, COMMAND, FILE])
-    stdout = subprocess.check_output( ["%s/blaze.sh" % local_dir, COMMAND, FILE],
-            # If you don't provide this option, it'll end up emitting some
-            # data to the screen.
-            cwd=CWD,
-            stderr=open(os.devnull, 'w'),)
-except subprocess.CalledProcessError as e:
-    # It's necessary to catch this error because rust will
-    # intentionally return exit code > 0 when the build/test
-    # fails, but it'll still output the correct info.
-    stdout = e.output
-
-quickfix = []
-try:
-    errors, warnings = parse.parse_bazel_output(
-            COMMAND,
-            str(stdout),
-            transform_relative_path
+
+    # With build_events, the messages come from bazel's Build Event
+    # Protocol instead of its console output. The events file is read while
+    # bazel writes it, and failures are reported per target, including the
+    # ones that don't come with a rustc diagnostic.
+    build_events = options.get("build_events") and command in ("build", "test")
+
+    def run_events(bazel_dir, argv, cache, transform_relative_path):
+        def label_path(label):
+            return _label_path(label, bazel_dir, cwd)
+
+        fd, events_path = tempfile.mkstemp(prefix="cargo-vim-", suffix=".json")
+        os.close(fd)
+        os.remove(events_path)
+        try:
+            if job.cancelled:
+                return
+            process = job.start(
+                argv[:2] + ["--build_event_json_file=%s" % events_path, "--color=no"] + argv[2:],
+                bazel_dir
             )
-except parse.CargoParseError as e:
-    error(str(e))
-
-reason = "`cargo %s`: success" % COMMAND
-if len(errors) > 0:
-    reason = "`cargo %s` failed, check quickfix" % COMMAND
-    quickfix = errors
-elif len(warnings) > 0:
-    reason = "`cargo %s` succeeded with warnings, check quickfix" % COMMAND
-    quickfix = warnings
-
-finish({ "message": reason, "quickfix": [m.render() for m in quickfix] })
+            lines = recorder.lines(jobs.follow(events_path, process))
+            events = parse.decode_events(lines, recorder)
+            for batch in recorder.iterate("parse", parse.iter_build_events(events, transform_relative_path, label_path)):
+                add(batch)
+                if cache is not None:
+                    cache.add(batch)
+                if collector.full():
+                    collector.stop()
+                    lines.close()
+                    return
+            if cache is not None and not job.cancelled:
+                with recorder.phase("cache"):
+                    cache.finish(process.poll())
+        finally:
+            if os.path.exists(events_path):
+                os.remove(events_path)
+
+    def build(bazel_dir, sources):
+        def transform_relative_path(file_path):
+            return parse.transform_relative_path(file_path, bazel_dir, cwd)
+        transform_relative_path = recorder.timed("paths", transform_relative_path)
+
+        argv = ["%s/blaze.sh" % local_dir, command]
+        if test_filter:
+            argv.append("--test_filter=%s" % test_filter)
+        argv += sources
+
+        cache = None
+        if command == "build" and options.get("build_cache"):
+            with recorder.phase("cache"):
+                cache = builds.Build([bazel_dir], argv + [cwd, bool(build_events)])
+                cached = cache.cached()
+            if cached is not None:
+                recorder.count("cached_builds")
+                collector.add(cached)
+                return
+
+        if build_events:
+            run_events(bazel_dir, argv, cache, transform_relative_path)
+            return
+
+        status = {}
+        lines = recorder.lines(job.lines(argv, bazel_dir, status))
+        batches = []
+        if command == "build":
+            batches = parse.iter_bazel_build_output(lines, transform_relative_path)
+        elif command == "test":
+            batches = parse.iter_test_output(lines, transform_relative_path)
+        for batch in recorder.iterate("parse", batches):
+            add(batch)
+            if cache is not None:
+                cache.add(batch)
+            # The log of a large failing build can run into hundreds of MB,
+            # so stop bazel once there are enough messages to go on.
+            if collector.full():
+                collector.stop()
+                lines.close()
+                return
+        # Other commands just need to finish.
+        for line in lines:
+            pass
+        if cache is not None and not job.cancelled:
+            with recorder.phase("cache"):
+                cache.finish(status["returncode"])
+
+    try:
+        jobs.parallel(
+            [
+                lambda b=b, s=s: build(b, s)
+                for b, s in sorted(workspaces.items())
+            ],
+            options.get("parallel", 4)
+        )
+    except parse.CargoParseError as e:
+        return results.result(str(e))
+
+    if job.cancelled:
+        return results.result("`bazel %s` was cancelled" % command)
+
+    response = collector.finish("bazel", command, merged=len(workspaces) > 1)
+    if tests is not None:
+        # rust_test passes --test_filter on as a plain libtest filter, which
+        # matches any test whose name contains it.
+        response["tests"] = {"filter": test_filter, "exact": False, "target": test_target}
+    return stats.finish(recorder, response, "bazel", command, cwd, options)
+
+# _label_path returns the BUILD file of the package of `label`, relative to
+# `cwd`, or None for labels outside of the workspace.
+def _label_path(label, bazel_dir, cwd):
+    if not label.startswith("//"):
+        return None
+    package = label[2:].split(":")[0]
+    for name in ("BUILD.bazel", "BUILD"):
+        path = os.path.join(bazel_dir, package, name)
+        if os.path.isfile(path):
+            return os.path.relpath(path, cwd)
+    return None
+
+def main(argv):
+    args, options = jobs.parse_args(argv)
+    # Sometimes not enough parameters are passed in, which means that the
+    # user tried to run `bazel build` on an empty buffer, or something
+    # like that.
+    if len(args) < 3:
+        return results.result("Can't find WORKSPACE, is this a bazel project?")
+
+    # Vim stops the job with SIGTERM when a new command is started. Pass
+    # that on to bazel, which would otherwise keep building in the
+    # background.
+    job = jobs.Job()
+    def cancel(signum, frame):
+        job.cancel()
+        sys.exit(1)
+    signal.signal(signal.SIGTERM, cancel)
+
+    return run(args[0], args[1], args[2], results.emit if options.get("stream") else None, job, options)
+
+if __name__ == '__main__':
+    results.write(main(sys.argv), jobs.parse_args(sys.argv)[1])
@@ -0,0 +1,240 @@
+#
+#   bench.py
+#
+#   bench.py measures how fast parse.py gets through large, synthetic build
+#   logs, so that changes to the parser can be checked for regressions.
+#
+#       python bench.py            # compare with the saved baseline
+#       python bench.py --save     # save the results as the new baseline
+#
+#   The baseline is kept in the cache directory (see store.py), since the
+#   numbers only mean something on the machine that measured them.
+
+import json
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import parse
+import store
+
+def path_transformer(path):
+    return path
+
+# cargo_log returns the JSON output of a failing `cargo build`, with
+# `count` compiler messages, each after `artifacts` compiled dependencies.
+# Every tenth message points into a macro, expanded `depth` macros deep.
+def cargo_log(count, depth=8, artifacts=3):
+    lines = []
+    for i in range(count):
+        span = {
+            "file_name": "src/module_%d.rs" % (i % 100),
+            "line_start": i,
+            "column_start": 9,
+            "label": "expected `i32`, found `&str`",
+            "expansion": None,
+        }
+        if i % 10 == 0:
+            for level in range(depth):
+                span = {
+                    "file_name": "<::core::macros::macro_%d macros>" % level,
+                    "line_start": 1,
+                    "column_start": 1,
+                    "label": None,
+                    "expansion": {
+                        "macro_decl_name": "macro_%d!" % level,
+                        "span": span,
+                        "def_site_span": None,
+                    },
+                }
+        lines.append(record("compiler-message", {
+            "package_id": "demo 0.1.0 (path+file:///src/demo)",
+            "message": {
+                "message": "mismatched types",
+                "code": {"code": "E0308", "explanation": None},
+                "level": "error" if i % 3 else "warning",
+                "spans": [span, {
+                    "file_name": "src/module_%d.rs" % (i % 100),
+                    "line_start": i - 1,
+                    "column_start": 12,
+                    "label": "expected due to this",
+                    "expansion": None,
+                }],
+                "children": [],
+                "rendered": "error[E0308]: mismatched types\n",
+            },
+        }))
+        # Dependencies make up most of the output of a real build.
+        for j in range(artifacts):
+            lines.append(record("compiler-artifact", {
+                "package_id": "dep_%d_%d 0.1.0 (registry+https://github.com/rust-lang/crates.io-index)" % (i, j),
+                "manifest_path": "/home/user/.cargo/registry/src/dep_%d_%d-0.1.0/Cargo.toml" % (i, j),
+                "target": {
+                    "kind": ["lib"],
+                    "crate_types": ["lib"],
+                    "name": "dep_%d_%d" % (i, j),
+                    "src_path": "/home/user/.cargo/registry/src/dep_%d_%d-0.1.0/src/lib.rs" % (i, j),
+                    "edition": "2021",
+                    "doc": True,
+                    "doctest": True,
+                    "test": True,
+                },
+                "profile": {
+                    "opt_level": "0",
+                    "debuginfo": 2,
+                    "debug_assertions": True,
+                    "overflow_checks": True,
+                    "test": False,
+                },
+                "features": ["default", "std"],
+                "filenames": [
+                    "/src/demo/target/debug/deps/libdep_%d_%d-%016x.%s" % (i, j, i * 31 + j, extension)
+                    for extension in ("rlib", "rmeta", "d")
+                ],
+                "executable": None,
+                "fresh": True,
+            }))
+    lines.append(record("build-finished", {"success": False}))
+    return "\n".join(lines)
+
+# record returns a line of cargo output. Like cargo, it writes the reason
+# first and leaves out the spaces.
+def record(reason, fields):
+    return '{"reason":%s,%s' % (json.dumps(reason), json.dumps(fields, separators=(",", ":"))[1:])
+
+# bazel_log returns the text of a failing bazel build, with `count` rustc
+# diagnostics separated by the usual bazel noise.
+def bazel_log(count):
+    blocks = []
+    for i in range(count):
+        blocks.append("""error[E0425]: cannot find value `value_%d` in this scope
+   --> pkg/module_%d/lib.rs:%d:23
+    |
+%d |         assert_eq!(0, value_%d);
+    |                       ^^^^^^^ not found in this scope
+    |
+    = help: consider importing this item
+help: a local variable with a similar name exists
+    |
+%d |         assert_eq!(0, value);
+    |                       ~~~~~
+
+warning: unused variable: `x`
+  --> pkg/module_%d/lib.rs:%d:9
+   |
+%d |     let x = 5;
+   |         ^ help: if this is intentional, prefix it with an underscore: `_x`
+   |
+   = note: `#[warn(unused_variables)]` on by default
+
+Target //pkg/module_%d:lib failed to build
+Use --verbose_failures to see the command lines of failed build steps.
+""" % ((i, i % 100, i, i, i, i, i % 100, i, i, i % 100)))
+    return "\n".join(blocks)
+
+# test_log returns the text output of `cargo test` with `count` failed
+# tests, alternating between the older and newer panic formats.
+def test_log(count):
+    lines = ["", "running %d tests" % (count * 2)]
+    for i in range(count):
+        lines.append("test tests::test_%d ... FAILED" % i)
+        lines.append("test tests::passes_%d ... ok" % i)
+    lines += ["", "failures:", ""]
+    for i in range(count):
+        lines.append("---- tests::test_%d stdout ----" % i)
+        if i % 2:
+            lines.append("thread 'tests::test_%d' panicked at 'assertion failed: `(left == right)`" % i)
+            lines.append("  left: `%d`," % i)
+            lines.append(" right: `%d`', src/module_%d.rs:%d:9" % (i + 1, i % 100, i))
+        else:
+            lines.append("thread 'tests::test_%d' panicked at src/module_%d.rs:%d:9:" % (i, i % 100, i))
+            lines.append("assertion `left == right` failed")
+            lines.append("  left: %d" % i)
+            lines.append(" right: %d" % (i + 1))
+        lines.append("note: run with `RUST_BACKTRACE=1` environment variable to display a backtrace")
+        lines.append("")
+    lines += ["failures:"] + ["    tests::test_%d" % i for i in range(count)]
+    lines.append("")
+    lines.append("test result: FAILED. %d passed; %d failed; 0 ignored; 0 measured" % (count, count))
+    return "\n".join(lines)
+
+# duplicate_messages returns `count` messages where every message appears
+# three times, as warnings from a crate that several others depend on do.
+def duplicate_messages(count):
+    messages = []
+    for i in range(count):
+        m = parse.Message()
+        m.filename = "src/module_%d.rs" % (i % 100)
+        m.line = i // 3
+        m.column = 9
+        m.level = 'warning'
+        m.text = "unused variable: `x_%d`" % (i // 3)
+        messages.append(m)
+    return messages
+
+# measure returns the best time of `repeat` calls to `function`, and the
+# peak memory that one call allocates (None without tracemalloc).
+def measure(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return best, peak
+
+def benchmarks():
+    cargo = cargo_log(10000)
+    bazel = bazel_log(4600)
+    tests = test_log(3000)
+    duplicates = duplicate_messages(30000)
+    return [
+        ("parse_build_output", cargo.count("\n") + 1,
+            lambda: parse.parse_build_output(cargo, path_transformer)),
+        ("parse_bazel_build_output", bazel.count("\n") + 1,
+            lambda: parse.parse_bazel_build_output(bazel, path_transformer)),
+        ("parse_test_output", tests.count("\n") + 1,
+            lambda: parse.parse_test_output(tests, path_transformer)),
+        ("_deduplicate_messages", len(duplicates),
+            lambda: parse._deduplicate_messages(duplicates)),
+    ]
+
+def main(argv, repeat=5):
+    path = store.path("bench.json")
+    baseline = store.load(path, {})
+    results = {}
+    for name, lines, function in benchmarks():
+        elapsed, peak = measure(function, repeat)
+        results[name] = {"lines_per_sec": lines / elapsed, "peak": peak}
+
+        comparison = ""
+        if name in baseline:
+            comparison = "  %+6.1f%% vs baseline" % (
+                100.0 * (lines / elapsed / baseline[name]["lines_per_sec"] - 1))
+        print("%-26s %8d lines  %8.3fs  %10.0f lines/sec  %8s peak%s" % (
+            name,
+            lines,
+            elapsed,
+            lines / elapsed,
+            "%.1fMB" % (peak / 1e6) if peak is not None else "?",
+            comparison
+        ))
+
+    if "--save" in argv:
+        store.save(path, results)
+        print("saved baseline to %s" % path)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,20 +1,40 @@
 #!/bin/bash
 
-FILE=$(bazel query $2)
-PACKAGE=$(bazel query $2 --output=package)
-TARGET=$(bazel query "attr('srcs', $FILE, ${FILE//:*/}:*)" | head -n 1)
-TEST_TARGET=$(bazel query "kind('.*test rule', attr('srcs', $FILE, ${FILE//:*/}:*))" 2>/dev/null | head -n 1)
+COMMAND=$1
+shift
 
-if [ "$1" == "test" ]; then
-  # Need to identify the tests which depend on this file, and run those. Pick the first one.
-  if [ -z "$TEST_TARGET" ]; then
-     TEST_TARGET=$(bazel query "kind('.*test rule', rdeps(//$PACKAGE/..., $TARGET))" | head -n 1)
+# Flags before the files are passed on to bazel, e.g. --test_filter.
+FLAGS=""
+while [[ "$1" == --* ]]; do
+  FLAGS="$FLAGS $1"
+  shift
+done
+
+# Find the targets for each of the files passed in.
+TARGETS=""
+TEST_TARGETS=""
+for SOURCE in "$@"; do
+  FILE=$(bazel query $SOURCE)
+  PACKAGE=$(bazel query $SOURCE --output=package)
+  TARGET=$(bazel query "attr('srcs', $FILE, ${FILE//:*/}:*)" | head -n 1)
+  TEST_TARGET=$(bazel query "kind('.*test rule', attr('srcs', $FILE, ${FILE//:*/}:*))" 2>/dev/null | head -n 1)
+
+  if [ "$COMMAND" == "test" ]; then
+    # Need to identify the tests which depend on this file, and run those. Pick the first one.
+    if [ -z "$TEST_TARGET" ]; then
+       TEST_TARGET=$(bazel query "kind('.*test rule', rdeps(//$PACKAGE/..., $TARGET))" | head -n 1)
+    fi
   fi
-  bazel test $TEST_TARGET --noshow_progress --test_output=errors 2>&1 | grep -v -e "^INFO:" -e "^FAILED:" -e "^ERROR:"
-elif [ "$1" == "build" ]; then
-  bazel build $TARGET --noshow_progress 2>&1 | grep -v -e "^INFO:" -e "^FAILED:" -e "^ERROR:"
+
+  TARGETS="$TARGETS $TARGET"
+  TEST_TARGETS="$TEST_TARGETS $TEST_TARGET"
+done
+
+if [ "$COMMAND" == "test" ]; then
+  bazel test $TEST_TARGETS $FLAGS --noshow_progress --test_output=errors 2>&1 | grep -v -e "^INFO:" -e "^FAILED:" -e "^ERROR:"
+elif [ "$COMMAND" == "build" ]; then
+  bazel build $TARGETS $FLAGS --noshow_progress 2>&1 | grep -v -e "^INFO:" -e "^FAILED:" -e "^ERROR:"
 else
   # Otherwise just build the corresponding target
-  bazel $1 $TARGET
+  bazel $COMMAND $TARGETS $FLAGS
 fi
-
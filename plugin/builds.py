@@ -0,0 +1,227 @@
+#
+#   builds.py
+#
+#   builds.py remembers the messages of recent builds, keyed by a
+#   fingerprint of everything the build reads: the source files, the
+#   manifests and lock files, the command line, and for cargo the
+#   toolchain and the environment. Building a tree that hasn't changed
+#   since then just replays the messages, without starting cargo or bazel
+#   at all.
+
+import hashlib
+import json
+import os
+import subprocess
+import threading
+
+import parse
+import roots
+import store
+
+# The number of builds to remember, and the total size of their messages.
+# The least recently used builds are dropped first.
+MAX_BUILDS = 50
+MAX_BYTES = 8 * 1024 * 1024
+
+# Trees with more files than this aren't fingerprinted, since going over
+# them would take about as long as asking the build tool.
+MAX_FILES = 20000
+
+# The trees that were found to have too many files. A large monorepo stays
+# large, so they aren't gone over again until one of their top
+# directories changes.
+_large = roots.RootCache(store.path("large.json"))
+
+# Directories that hold build outputs or version control data, rather than
+# anything the build reads.
+def _skip_directory(name):
+    return name.startswith(".") or name == "target" or name.startswith("bazel-")
+
+# fingerprint returns a hash of the files at `paths` (files, or
+# directories that are walked) and of `extra` (e.g. the command line), or
+# None if there are too many files. Files are compared by their size and
+# modification time, like make does, so that none of them has to be read.
+def fingerprint(paths, extra):
+    paths = _outermost(paths)
+    large = "\0".join(paths)
+    if _large.get(large):
+        return None
+
+    digest = hashlib.sha1(json.dumps(extra).encode('utf-8'))
+    count = 0
+    for path in paths:
+        for f in _files(path):
+            count += 1
+            if count > MAX_FILES:
+                _large.put(large, True, [p for p in paths if os.path.isdir(p)])
+                return None
+            try:
+                stat = os.stat(f)
+            except OSError:
+                continue
+            digest.update(("%s\0%d\0%r\0" % (f, stat.st_size, stat.st_mtime)).encode('utf-8'))
+    return digest.hexdigest()
+
+def _files(path):
+    if not os.path.isdir(path):
+        yield path
+        return
+    for directory, directories, files in os.walk(path):
+        directories[:] = sorted(d for d in directories if not _skip_directory(d))
+        for name in sorted(files):
+            yield os.path.join(directory, name)
+
+# _outermost returns `paths` without the ones inside another of them, so
+# that no file is counted twice.
+def _outermost(paths):
+    kept = []
+    for path in sorted(set(paths)):
+        if not any(path == k or path.startswith(k + os.sep) for k in kept):
+            kept.append(path)
+    return kept
+
+# The environment variables that change what cargo and rustc do.
+def _build_variable(name):
+    return name.startswith("CARGO_") or name.startswith("RUST")
+
+CARGO_CONFIGS = [os.path.join(".cargo", "config.toml"), os.path.join(".cargo", "config")]
+
+# cargo_inputs returns the paths and the extra values that a cargo build
+# in the workspace at `workspace_dir` depends on (see fingerprint): the
+# directories of its packages and of their path dependencies, the
+# workspace manifest and lock file, the toolchain file and cargo's config
+# files, and the versions of the toolchain and the build environment.
+def cargo_inputs(workspace_dir):
+    paths = [
+        os.path.join(workspace_dir, "Cargo.toml"),
+        os.path.join(workspace_dir, "Cargo.lock"),
+    ]
+    packages = roots.cargo_metadata(workspace_dir)
+    if not packages:
+        paths.append(workspace_dir)
+    for package in packages:
+        paths.append(package["dir"])
+        paths += package["path_dependencies"]
+
+    toolchain_file = roots.find_toolchain_file(workspace_dir)
+    if toolchain_file:
+        paths.append(toolchain_file)
+    directory = workspace_dir
+    while True:
+        paths += [os.path.join(directory, c) for c in CARGO_CONFIGS if os.path.isfile(os.path.join(directory, c))]
+        parent_directory = os.path.dirname(directory)
+        if parent_directory == directory:
+            break
+        directory = parent_directory
+
+    env = sorted((k, v) for k, v in os.environ.items() if _build_variable(k))
+    return paths, [toolchain(workspace_dir, toolchain_file), env]
+
+# toolchain returns the versions of rustc and cargo that rustup runs in
+# `directory`, where `toolchain_file` is its rust-toolchain file, if any.
+# Asking takes a moment, so the answer is remembered until the toolchain
+# file or rustup's settings and installed toolchains change.
+_toolchains = {}
+
+def toolchain(directory, toolchain_file):
+    home = os.environ.get("RUSTUP_HOME") or os.path.join(os.path.expanduser("~"), ".rustup")
+    key = (directory, toolchain_file, os.environ.get("RUSTUP_TOOLCHAIN")) + tuple(
+        _mtime(p) for p in [toolchain_file, os.path.join(home, "settings.toml"), os.path.join(home, "toolchains")]
+    )
+    if key not in _toolchains:
+        versions = []
+        for argv in (["rustc", "-vV"], ["cargo", "-V"]):
+            try:
+                output = subprocess.check_output(argv, cwd=directory, stderr=open(os.devnull, 'w'))
+                versions.append(output.decode('utf-8', 'replace'))
+            except (OSError, subprocess.CalledProcessError):
+                versions.append("")
+        _toolchains[key] = versions
+    return _toolchains[key]
+
+def _mtime(path):
+    try:
+        return path and os.stat(path).st_mtime
+    except OSError:
+        return None
+
+class Builds(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_path = os.path.join(directory, "index.json")
+        self.index = None
+        self.lock = threading.Lock()
+
+    def _load(self):
+        if self.index is None:
+            self.index = store.load(self.index_path, {})
+
+    def _path(self, key):
+        return os.path.join(self.directory, "%s.json" % key)
+
+    def _touch(self, key):
+        self.index[key]["order"] = max([b["order"] for b in self.index.values()] + [0]) + 1
+
+    # get returns the messages of the build with fingerprint `key`, or None
+    # if it isn't known.
+    def get(self, key):
+        if key is None:
+            return None
+        with self.lock:
+            self._load()
+            if key not in self.index:
+                return None
+            messages = store.load(self._path(key), None)
+            if messages is None:
+                del self.index[key]
+                return None
+            self._touch(key)
+            store.save(self.index_path, self.index)
+        return [parse.Message.load(m) for m in messages]
+
+    def put(self, key, messages):
+        if key is None:
+            return
+        data = [m.dump() for m in messages]
+        size = len(json.dumps(data))
+        if size > MAX_BYTES:
+            return
+        with self.lock:
+            self._load()
+            store.save(self._path(key), data)
+            self.index[key] = {"size": size, "order": 0}
+            self._touch(key)
+            while (len(self.index) > MAX_BUILDS or
+                    sum(b["size"] for b in self.index.values()) > MAX_BYTES):
+                oldest = min(self.index, key=lambda k: self.index[k]["order"])
+                del self.index[oldest]
+                store.remove(self._path(oldest))
+            store.save(self.index_path, self.index)
+
+_builds = Builds(store.path("builds"))
+
+# Build is one build, which either replays the cached messages or records
+# them for the next time. `extra` is everything besides the files at
+# `paths` that the result depends on (see fingerprint).
+class Build(object):
+    def __init__(self, paths, extra):
+        self.key = fingerprint(paths, extra)
+        self.messages = []
+
+    def cached(self):
+        return _builds.get(self.key)
+
+    def add(self, batch):
+        self.messages.extend(batch)
+
+    # finish records the messages for the next time, if they explain how the
+    # build ended with `returncode`: it succeeded, or it failed with errors.
+    # A build that failed without an error message (e.g. a failed build
+    # script, a broken manifest or a network error) isn't remembered, and
+    # neither is one that didn't run to the end (a None `returncode`).
+    def finish(self, returncode):
+        if returncode is None:
+            return
+        if returncode != 0 and all(m.level == 'warning' for m in self.messages):
+            return
+        _builds.put(self.key, self.messages)
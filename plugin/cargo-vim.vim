@@ -11,33 +11,1045 @@
 
 let s:plugin_path = expand('<sfile>:p:h')
 
-func! RunCargoCommand(command)
+" The build commands take an optional scope: `buffers` builds the
+" packages of all the rust files open in vim, and `modified` the ones with
+" changes in git. Without it, just the package of the current file is built.
+func! RunCargoCommand(command, ...)
   echom "running `cargo " . a:command . "`..."
-  let data = eval(system("python " . s:plugin_path . "/cargo.py " . a:command . " " . expand('%:p') . " " . getcwd()))
-  call setqflist(data.quickfix)
+  call s:Run("cargo", "cargo.py", a:command, expand('%:p'), s:Options(a:000))
+endf
+
+func! RunBlazeCommand(command, ...)
+  echom "python " . s:plugin_path . "/bazel.py " . a:command . " " . expand('%') . " " . getcwd()
+  call s:Run("bazel", "bazel.py", a:command, expand('%'), s:Options(a:000))
+endf
+
+" CargoTestHere runs only the test function under the cursor, or else the
+" tests module it's in, or else the tests in the current file. Instead of
+" replacing the quickfix list, the results are merged into it.
+func! CargoTestHere()
+  let options = s:Options([])
+  let options.tests = s:TestsHere()
+  echom "running `cargo test " . join(options.tests.path, "::") . "`..."
+  call s:Run("cargo", "cargo.py", "test", expand('%:p'), options)
+endf
+
+func! BlazeTestHere()
+  let options = s:Options([])
+  let options.tests = s:TestsHere()
+  echom "running `bazel test " . join(options.tests.path, "::") . "`..."
+  call s:Run("bazel", "bazel.py", "test", expand('%'), options)
+endf
+
+func! s:Run(tool, script, command, file, options)
+  if s:UseAsync()
+    call s:StartCommand(a:tool, a:script, a:command, a:file, a:options)
+    return
+  endif
+  " The result is written to a file, which is much faster to read than
+  " the output of system() when the list is large.
+  let options = copy(a:options)
+  let options.output = tempname()
+  let error = system("python " . s:plugin_path . "/" . a:script . " " . a:command . " " . a:file . " " . getcwd() . " " . shellescape(s:OptionsArg(options)))
+  if !filereadable(options.output)
+    echom a:script . " failed: " . error
+    return
+  endif
+  let data = json_decode(join(readfile(options.output), "\n"))
+  call delete(options.output)
+  if has_key(data, 'tests')
+    let keys = {}
+    for entry in data.quickfix
+      let keys[entry.key] = 1
+    endfor
+    call s:QuickfixResume()
+    call s:MergeEntries(data.quickfix)
+    call s:RemoveEntries(s:StaleTests(data.tests, keys))
+    let s:snapshot = ""
+  else
+    let s:entries = data.quickfix
+    call s:EntriesChanged()
+    let s:snapshot = get(data, 'snapshot', "")
+    call s:QuickfixNew(s:Flatten(data.quickfix))
+  endif
+  call s:RecordStats(data)
   echom data.message
-  if len(data.quickfix)
+  if !s:QuickfixEmpty()
     copen
   else
     cclose
   endif
 endf
 
+" s:Options collects the settings that the python side needs to know about.
+" `args` are the arguments of the build command, if any.
+func! s:Options(args)
+  let options = {
+        \ 'merge_duplicates': get(g:, 'cargo_merge_duplicates', 0),
+        \ 'parallel': get(g:, 'cargo_parallel_jobs', 4),
+        \ 'test_json': get(g:, 'cargo_test_json', 1),
+        \ 'build_cache': get(g:, 'cargo_build_cache', 0),
+        \ 'package_scope': get(g:, 'cargo_package_scope', 1),
+        \ 'max_messages': get(g:, 'cargo_max_messages', 1000),
+        \ 'build_events': get(g:, 'cargo_bazel_build_events', 0),
+        \ 'stats': get(g:, 'cargo_stats', 0),
+        \ 'stats_log': expand(get(g:, 'cargo_stats_log', '')),
+        \ }
+  let scope = get(a:args, 0, "")
+  if scope ==# "buffers"
+    let options.files = map(filter(range(1, bufnr('$')),
+          \ 'buflisted(v:val) && bufname(v:val) =~# "\\.rs$"'),
+          \ 'fnamemodify(bufname(v:val), ":p")')
+  elseif scope ==# "modified"
+    let options.files = "git"
+  endif
+  return options
+endf
 
-func! RunBlazeCommand(command)
-  echom "python " . s:plugin_path . "/bazel.py " . a:command . " " . expand('%') . " " . getcwd()
-  let data = eval(system("python " . s:plugin_path . "/bazel.py " . a:command . " " . expand('%') . " " . getcwd()))
-  call setqflist(data.quickfix)
-  echom data.message
-  if len(data.quickfix)
-    copen
+func! s:OptionsArg(options)
+  return "--options=" . json_encode(a:options)
+endf
+
+" Messages arrive as trees: a top level message can have `children` with
+" the source snippets, notes and help hints that belong to it. s:Flatten
+" turns them into quickfix entries, leaving the children out while
+" g:cargo_fold_messages is set. The children of children come as children
+" of the top level message (see parse.Message.render_tree), so the list is
+" only ever two levels deep. Going over a large list in vimscript takes
+" much longer than decoding it, so it's flattened with flatten() where
+" there is one.
+"
+" s:entries holds the top level messages in the quickfix list, and
+" s:snapshot the id the python side gave to that list (see snapshots.py).
+let s:entries = []
+let s:snapshot = ""
+
+func! s:Flatten(entries)
+  if get(g:, 'cargo_fold_messages', 0)
+    return a:entries
+  endif
+  if exists('*flatten')
+    return flatten(map(copy(a:entries), '[v:val] + get(v:val, "children", [])'), 1)
+  endif
+  let flat = []
+  for entry in a:entries
+    call add(flat, entry)
+    call extend(flat, get(entry, 'children', []))
+  endfor
+  return flat
+endf
+
+" The list of the build is told apart from other quickfix lists (e.g. of
+" :vimgrep) by its id, s:qf_id, and all changes go to that list. A command
+" only patches it or adds to it while it's still the current list. If
+" another list has been made current, or the build's list is gone, the
+" command starts a new list instead.
+let s:qf_id = 0
+
+func! s:QuickfixNew(items)
+  call setqflist([], ' ', {'items': a:items, 'title': 'cargo-vim'})
+  let s:qf_id = getqflist({'id': 0}).id
+endf
+
+func! s:QuickfixCurrent()
+  return s:qf_id != 0 && getqflist({'id': 0}).id == s:qf_id
+endf
+
+func! s:QuickfixExists()
+  return s:qf_id != 0 && getqflist({'id': s:qf_id}).id == s:qf_id
+endf
+
+" s:QuickfixResume makes sure the current list is the build's list, with
+" the messages in s:entries.
+func! s:QuickfixResume()
+  if !s:QuickfixCurrent()
+    call s:QuickfixNew(s:Flatten(s:entries))
+  endif
+endf
+
+" s:QuickfixSet changes the build's list, see setqflist().
+func! s:QuickfixSet(action, what)
+  if s:QuickfixExists()
+    call setqflist([], a:action, extend({'id': s:qf_id}, a:what))
+  endif
+endf
+
+" s:QuickfixEmpty returns whether the build's list is empty, without
+" copying it like getqflist() does.
+func! s:QuickfixEmpty()
+  return !s:QuickfixExists() || getqflist({'id': s:qf_id, 'size': 0}).size == 0
+endf
+
+" s:QuickfixIndex returns the selected entry of the build's list.
+func! s:QuickfixIndex()
+  return s:QuickfixExists() ? getqflist({'id': s:qf_id, 'idx': 0}).idx : 0
+endf
+
+" s:Selected returns the message that the quickfix entry `idx` of `items`
+" (the flattened list) belongs to, and which of its entries it is,
+" counting from 1. Only top level messages have a key.
+func! s:Selected(items, idx)
+  if a:idx < 1 || a:idx > len(a:items)
+    return [{}, 0]
+  endif
+  let top = a:idx - 1
+  while top > 0 && !has_key(a:items[top], 'key')
+    let top -= 1
+  endwhile
+  return [a:items[top], a:idx - top]
+endf
+
+" s:RemoveEntries takes the messages with the given keys out of the
+" quickfix list, without moving the selection off the message it's on.
+func! s:RemoveEntries(keys)
+  let removed = {}
+  for key in a:keys
+    let removed[key] = 1
+  endfor
+
+  let [selected, offset] = s:Selected(s:Flatten(s:entries), s:QuickfixIndex())
+  let keep = '!has_key(removed, get(v:val, "key", ""))'
+  let new_idx = 1
+  if !empty(selected)
+    " The entries before the selected message that are kept, then either
+    " the same entry of it, or the entry after it if it's removed.
+    let i = index(s:entries, selected)
+    let new_idx = len(s:Flatten(filter(s:entries[: i], keep)))
+    if has_key(removed, get(selected, 'key', ""))
+      let new_idx += 1
+    else
+      let new_idx += offset - len(s:Flatten([selected]))
+    endif
+  endif
+
+  let s:entries = filter(s:entries, keep)
+  call s:EntriesChanged()
+  let items = s:Flatten(s:entries)
+  call s:QuickfixSet('r', {'items': items, 'idx': max([1, min([new_idx, len(items)])])})
+endf
+
+" s:SortEntries sorts the messages by location, keeping the selection on
+" the message it's on. Builds that ran in parallel report their messages
+" in whatever order they finish in.
+func! s:SortEntries()
+  let [selected, offset] = s:Selected(s:Flatten(s:entries), s:QuickfixIndex())
+  call sort(s:entries, {a, b -> a.filename < b.filename ? -1 : a.filename > b.filename ? 1 : a.lnum != b.lnum ? a.lnum - b.lnum : get(a, 'col', 0) - get(b, 'col', 0)})
+  let items = s:Flatten(s:entries)
+  let new_idx = empty(selected) ? 1 : index(items, selected) + offset
+
+  call s:EntriesChanged([])
+  call s:QuickfixSet('r', {'items': items, 'idx': max([1, new_idx])})
+endf
+
+" s:MergeEntries adds the messages that aren't in the list yet.
+func! s:MergeEntries(entries)
+  let keys = {}
+  for entry in s:entries
+    let keys[get(entry, 'key', "")] = 1
+  endfor
+  let entries = filter(copy(a:entries), '!has_key(keys, v:val.key)')
+  call extend(s:entries, entries)
+  call s:EntriesChanged(entries)
+  call s:QuickfixSet('a', {'items': s:Flatten(entries)})
+endf
+
+" Targeted tests
+"
+" s:TestsHere finds the tests around the cursor: the names of the inline
+" modules it's in, followed by the function it's in if that's a test. It
+" goes by indentation, taking the closest declaration above the cursor
+" that's indented less than everything found so far.
+func! s:TestsHere()
+  let path = []
+  let exact = 0
+  let in_function = 0
+  let limit = indent(line('.')) + 1
+  let lnum = line('.')
+  while lnum > 0 && limit > 0
+    let line = getline(lnum)
+    if line !~ '^\s*$' && indent(lnum) < limit
+      let fn_decl = matchlist(line, '^\s*\%(pub\%(([^)]*)\)\=\s\+\)\=\%(\%(const\|async\|unsafe\)\s\+\)*fn\s\+\(\w\+\)')
+      let mod_decl = matchlist(line, '^\s*\%(pub\%(([^)]*)\)\=\s\+\)\=mod\s\+\(\w\+\)\s*{')
+      if !empty(fn_decl)
+        if !in_function && s:IsTest(lnum)
+          let path = [fn_decl[1]]
+          let exact = 1
+        endif
+        let in_function = 1
+        let limit = indent(lnum)
+      elseif !empty(mod_decl)
+        call insert(path, mod_decl[1])
+        let limit = indent(lnum)
+      endif
+    endif
+    let lnum -= 1
+  endwhile
+  return {'path': path, 'exact': exact}
+endf
+
+" s:IsTest returns whether the function declared on `lnum` has a test
+" attribute, like #[test] or #[tokio::test].
+func! s:IsTest(lnum)
+  let lnum = a:lnum - 1
+  while lnum > 0 && getline(lnum) =~ '^\s*\%(#\[\|//\)'
+    if getline(lnum) =~ '^\s*#\[\%(\w\+::\)*test\>'
+      return 1
+    endif
+    let lnum -= 1
+  endwhile
+  return 0
+endf
+
+" s:StaleTests returns the keys of the failures in the list that belong
+" to the tests of a targeted run, but weren't reported by it (the `keys`),
+" i.e. the tests that pass now. Only test failures that were reported by
+" a run of the same target are taken off the list, and nothing is when the
+" run had no filter, since it can't be told which tests it covered.
+func! s:StaleTests(tests, keys)
+  if get(a:tests, 'filter', "") == ""
+    return []
+  endif
+  let stale = []
+  for entry in s:entries
+    let test = get(entry, 'test', {})
+    if empty(test) || get(test, 'target', "") !=# get(a:tests, 'target', "") || has_key(a:keys, get(entry, 'key', ""))
+      continue
+    endif
+    if a:tests.exact ? test.name ==# a:tests.filter : stridx(test.name, a:tests.filter) >= 0
+      call add(stale, entry.key)
+    endif
+  endfor
+  return stale
+endf
+
+func! CargoFoldMessages()
+  let g:cargo_fold_messages = !get(g:, 'cargo_fold_messages', 0)
+  call s:QuickfixSet('r', {'items': s:Flatten(s:entries)})
+endf
+
+" Per-file index
+"
+" s:Index groups the messages by file, so that the messages for a buffer
+" can be found without going over the whole list. It's built when it's
+" first needed after the messages change, and messages that are added to
+" the list while it exists are added to it as well. s:IndexFile sorts the
+" messages of a file by line when they're asked for, so that the next or
+" previous one can be found by binary search.
+
+let s:paths = {}
+
+func! s:Index()
+  if !exists('s:index')
+    let s:index = {}
+    let s:paths = {}
+    call s:AddToIndex(s:entries)
+  endif
+  return s:index
+endf
+
+func! s:AddToIndex(entries)
+  for entry in a:entries
+    let path = has_key(s:paths, entry.filename) ? s:paths[entry.filename] : s:IndexPath(entry.filename)
+    call add(s:index[path].entries, entry)
+  endfor
+endf
+
+func! s:IndexPath(filename)
+  let path = fnamemodify(a:filename, ':p')
+  let s:paths[a:filename] = path
+  if !has_key(s:index, path)
+    let s:index[path] = {'entries': [], 'lines': [], 'sorted': 0}
+  endif
+  return path
+endf
+
+" A file's messages are sorted while `sorted` is the number of them.
+func! s:IndexFile(path)
+  let file = get(s:Index(), a:path, {'entries': [], 'lines': [], 'sorted': 0})
+  if file.sorted != len(file.entries)
+    call sort(file.entries, {a, b -> a.lnum - b.lnum})
+    let file.lines = map(copy(file.entries), 'v:val.lnum')
+    let file.sorted = len(file.entries)
+  endif
+  return file
+endf
+
+func! s:FileIndex()
+  return s:IndexFile(expand('%:p'))
+endf
+
+" s:Bisect returns the number of items in the sorted list `lines` that are
+" less than `line`, or less than or equal to it if `inclusive` is set.
+func! s:Bisect(lines, line, inclusive)
+  let lo = 0
+  let hi = len(a:lines)
+  while lo < hi
+    let mid = (lo + hi) / 2
+    if a:lines[mid] < a:line || (a:inclusive && a:lines[mid] == a:line)
+      let lo = mid + 1
+    else
+      let hi = mid
+    endif
+  endwhile
+  return lo
+endf
+
+" CargoDiagnosticsHere puts the messages for the current buffer into its
+" location list.
+func! CargoDiagnosticsHere()
+  let entries = s:FileIndex().entries
+  call setloclist(0, s:Flatten(entries))
+  if len(entries)
+    lopen
   else
-    cclose
+    lclose
+    echom "no messages for this file"
+  endif
+endf
+
+" CargoJumpDiagnostic moves the cursor to the next (direction 1) or
+" previous (direction -1) message in the current buffer, wrapping around
+" at the end of the file.
+func! CargoJumpDiagnostic(direction)
+  let file = s:FileIndex()
+  if empty(file.lines)
+    echom "no messages for this file"
+    return
+  endif
+
+  let line = line('.')
+  if a:direction > 0
+    let i = s:Bisect(file.lines, line, 1)
+    let i = i < len(file.lines) ? i : 0
+  else
+    let i = s:Bisect(file.lines, line, 0) - 1
   endif
+  let entry = file.entries[i]
+  call cursor(entry.lnum, 1)
+  echo entry.text
+endf
+
+" Inline messages
+"
+" With g:cargo_signs, the lines with messages get a sign, and with
+" g:cargo_virtual_text (Neovim only) the message itself is shown at the
+" end of the line. When the messages change, only the buffers visible in
+" the current tab page are updated, from the per-file index. The others
+" catch up when they're shown in a window again. Each buffer remembers
+" what it shows on every line, so an update only touches the lines whose
+" messages changed, instead of clearing and placing everything again.
+"
+" s:inline holds that for each buffer, along with the s:inline_version it
+" was last updated for.
+
+let s:inline = {}
+let s:inline_version = 0
+let s:inline_timer = -1
+
+hi def link CargoErrorSign ErrorMsg
+hi def link CargoWarningSign WarningMsg
+hi def link CargoErrorText ErrorMsg
+hi def link CargoWarningText WarningMsg
+if exists('*sign_define')
+  call sign_define('CargoError', {'text': 'E>', 'texthl': 'CargoErrorSign'})
+  call sign_define('CargoWarning', {'text': 'W>', 'texthl': 'CargoWarningSign'})
+endif
+if exists('*nvim_create_namespace')
+  let s:namespace = nvim_create_namespace('cargo')
+endif
+
+" s:EntriesChanged is called whenever s:entries changes, with the messages
+" that were added if that's all that changed. While a command is streaming
+" its messages, the buffers are updated a few times a second rather than
+" for every batch.
+func! s:EntriesChanged(...)
+  if a:0 && exists('s:index')
+    call s:AddToIndex(a:1)
+  else
+    unlet! s:index
+  endif
+  let s:inline_version += 1
+  if !has('timers')
+    call s:RenderVisible()
+  elseif s:inline_timer == -1
+    let s:inline_timer = timer_start(s:active == -1 ? 0 : 200, function('s:OnInlineTimer'))
+  endif
+endf
+
+func! s:OnInlineTimer(timer)
+  let s:inline_timer = -1
+  call s:RenderVisible()
+endf
+
+func! s:RenderVisible()
+  for bufnr in uniq(sort(tabpagebuflist(), 'n'))
+    call s:RenderBuffer(bufnr)
+  endfor
+endf
+
+" s:RenderBuffer brings the signs and virtual text of a buffer up to date
+" with the messages.
+func! s:RenderBuffer(bufnr)
+  let state = get(s:inline, a:bufnr, {})
+  if get(state, 'version', -1) == s:inline_version
+    return
+  endif
+  let signs = get(g:, 'cargo_signs', 1) && exists('*sign_place')
+  let virtual_text = get(g:, 'cargo_virtual_text', 0) && exists('*nvim_buf_set_extmark')
+  if empty(state)
+    if !signs && !virtual_text
+      return
+    endif
+    " Anything left over from before the buffer was unloaded.
+    call s:ClearBuffer(a:bufnr)
+    let state = {'lines': {}}
+    let s:inline[a:bufnr] = state
+  endif
+  let state.version = s:inline_version
+
+  " The most severe message on each line.
+  let wanted = {}
+  if signs || virtual_text
+    let path = fnamemodify(bufname(a:bufnr), ':p')
+    for entry in s:IndexFile(path).entries
+      let line = get(wanted, entry.lnum, {})
+      if empty(line) || (line.type ==# 'W' && entry.type !=# 'W')
+        let text = get(split(entry.text, "\n"), 0, "")
+        let wanted[entry.lnum] = {'type': entry.type, 'text': text,
+              \ 'key': signs . virtual_text . entry.type . text}
+      endif
+    endfor
+  endif
+
+  let placed = state.lines
+  for [lnum, line] in items(placed)
+    if !has_key(wanted, lnum) || wanted[lnum].key !=# line.key
+      call s:Unplace(a:bufnr, line)
+      unlet placed[lnum]
+    endif
+  endfor
+  let last = s:LineCount(a:bufnr)
+  for [lnum, line] in items(wanted)
+    if !has_key(placed, lnum) && lnum >= 1 && lnum <= last
+      let placed[lnum] = s:Place(a:bufnr, str2nr(lnum), line, signs, virtual_text)
+    endif
+  endfor
+endf
+
+func! s:Place(bufnr, lnum, line, signs, virtual_text)
+  let name = a:line.type ==# 'W' ? 'CargoWarning' : 'CargoError'
+  let placed = {'key': a:line.key, 'sign': 0, 'mark': 0}
+  if a:signs
+    let placed.sign = sign_place(0, 'cargo', name, a:bufnr, {'lnum': a:lnum})
+  endif
+  if a:virtual_text
+    let placed.mark = nvim_buf_set_extmark(a:bufnr, s:namespace, a:lnum - 1, 0,
+          \ {'virt_text': [[a:line.text, name . 'Text']]})
+  endif
+  return placed
+endf
+
+func! s:Unplace(bufnr, line)
+  if a:line.sign
+    call sign_unplace('cargo', {'buffer': a:bufnr, 'id': a:line.sign})
+  endif
+  if a:line.mark
+    call nvim_buf_del_extmark(a:bufnr, s:namespace, a:line.mark)
+  endif
+endf
+
+func! s:ClearBuffer(bufnr)
+  if exists('*sign_unplace')
+    call sign_unplace('cargo', {'buffer': a:bufnr})
+  endif
+  if exists('s:namespace')
+    call nvim_buf_clear_namespace(a:bufnr, s:namespace, 0, -1)
+  endif
+endf
+
+func! s:LineCount(bufnr)
+  if exists('*nvim_buf_line_count')
+    return nvim_buf_line_count(a:bufnr)
+  endif
+  let info = getbufinfo(a:bufnr)
+  if empty(info)
+    return 0
+  endif
+  return has_key(info[0], 'linecount') ? info[0].linecount : len(getbufline(a:bufnr, 1, '$'))
+endf
+
+augroup cargo_inline
+  autocmd!
+  autocmd BufWinEnter * call s:RenderBuffer(str2nr(expand('<abuf>')))
+  autocmd TabEnter * call s:RenderVisible()
+  autocmd BufUnload * silent! unlet s:inline[expand('<abuf>')]
+augroup END
+
+" CargoStatus returns a short description of the running or most recent
+" command, e.g. for use in 'statusline': set statusline+=%{CargoStatus()}
+func! CargoStatus()
+  return s:status
+endf
+
+" Async mode
+"
+" Commands run in the background so that the editor doesn't freeze during
+" the build. By default they're sent to server.py, a python process that
+" stays running between commands; if it can't be started, each command
+" runs cargo.py or bazel.py as its own Vim 8 / Neovim job instead.
+"
+" Either way the python side writes one line of JSON for each batch of
+" messages, which is appended to the quickfix list as it arrives. The
+" last line carries the final status message. Only one command runs at
+" a time: starting a new one cancels the running one. The server starts
+" the next command in the same project once the cancelled one has stopped,
+" so that they don't wait on each other for cargo's lock, and every line
+" carries the id of its command, so that a late result of the cancelled
+" one is ignored.
+"
+" With g:cargo_incremental, the quickfix list isn't cleared when a command
+" starts. Only new messages are sent, and the final line lists the ones
+" that have gone away, so the list is patched in place.
+
+let s:job = 0
+let s:server = 0
+let s:server_request = -1
+let s:generation = 0
+let s:active = -1
+let s:partial_lines = {}
+let s:status = ""
+let s:merging = 0
+let s:run_keys = {}
+
+func! s:UseAsync()
+  return get(g:, 'cargo_async', 1) && (has('nvim') || has('job'))
+endf
+
+" The priority is "interactive", unless it's given as "background" (see
+" server.py).
+func! s:StartCommand(tool, script, command, file, options, ...)
+  call s:StopCommand()
+  let priority = get(a:000, 0, "interactive")
+  let s:checking = priority ==# "background"
+  let s:generation += 1
+  let s:active = s:generation
+  let s:running = a:tool . " " . a:command
+  let s:count = 0
+  call s:SetStatus("`" . s:running . "`: running")
+
+  let options = copy(a:options)
+  let s:merging = has_key(options, 'tests')
+  let s:run_keys = {}
+  if s:merging
+    " Targeted test runs add to the list.
+    call s:QuickfixResume()
+  elseif get(g:, 'cargo_incremental', 1) && s:snapshot != "" && s:QuickfixCurrent()
+    let options.snapshot = s:snapshot
+  else
+    let s:entries = []
+    let s:snapshot = ""
+    call s:EntriesChanged()
+    call s:QuickfixNew([])
+  endif
+
+  if s:StartServer()
+    let s:server_request = s:generation
+    call s:Send({'id': s:generation, 'method': 'run', 'tool': a:tool,
+          \ 'command': a:command, 'file': a:file, 'cwd': getcwd(),
+          \ 'options': options, 'priority': priority})
+    return
+  endif
+
+  let argv = ["python", s:plugin_path . "/" . a:script, a:command, a:file, getcwd(), "--stream", s:OptionsArg(options)]
+  let s:partial_lines.job = ""
+  if has('nvim')
+    let s:job = jobstart(argv, {
+          \ 'on_stdout': function('s:OnNvimOutput', ['job', function('s:OnOutput', [s:generation])]),
+          \ 'on_exit': function('s:OnExit', [s:generation])})
+  else
+    let s:job = job_start(argv, {
+          \ 'out_mode': 'nl',
+          \ 'out_cb': function('s:OnOutput', [s:generation]),
+          \ 'close_cb': function('s:OnExit', [s:generation])})
+  endif
+endf
+
+func! s:StopCommand()
+  " The list may have been partly updated, so it no longer matches the
+  " snapshot.
+  if s:active != -1
+    let s:snapshot = ""
+  endif
+  if s:active == s:server_request && s:IsRunning(s:server)
+    call s:Send({'id': s:active, 'method': 'cancel'})
+  elseif s:IsRunning(s:job)
+    if has('nvim')
+      call jobstop(s:job)
+    else
+      call job_stop(s:job)
+    endif
+  endif
+  let s:job = 0
+  let s:active = -1
+endf
+
+func! s:IsRunning(job)
+  if has('nvim')
+    return a:job > 0 && jobwait([a:job], 0)[0] == -1
+  endif
+  return type(a:job) == v:t_job && job_status(a:job) ==# "run"
+endf
+
+" s:StartServer makes sure server.py is running, and returns whether it
+" can be used.
+func! s:StartServer()
+  if !get(g:, 'cargo_server', 1)
+    return 0
+  endif
+  if s:IsRunning(s:server)
+    return 1
+  endif
+
+  let argv = ["python", s:plugin_path . "/server.py"]
+  let s:partial_lines.server = ""
+  if has('nvim')
+    let s:server = jobstart(argv, {
+          \ 'on_stdout': function('s:OnNvimOutput', ['server', function('s:OnServerOutput')]),
+          \ 'on_exit': function('s:OnServerExit')})
+  else
+    let s:server = job_start(argv, {
+          \ 'out_mode': 'nl',
+          \ 'out_cb': function('s:OnServerOutput'),
+          \ 'close_cb': function('s:OnServerExit')})
+  endif
+  return s:IsRunning(s:server)
+endf
+
+func! s:Send(request)
+  let line = json_encode(a:request) . "\n"
+  if has('nvim')
+    call chansend(s:server, line)
+  else
+    call ch_sendraw(job_getchannel(s:server), line)
+  endif
+endf
+
+func! s:OnServerOutput(channel, line)
+  if a:line == ""
+    return
+  endif
+  let data = json_decode(a:line)
+  if type(data.id) == v:t_string
+    call s:OnFormatted(data)
+    return
+  endif
+  call s:OnData(data.id, data)
+endf
+
+" If the server goes away, the command it was running is lost. The next
+" command will start a new server.
+func! s:OnServerExit(...)
+  let s:server = 0
+  call s:OnExit(s:server_request)
+endf
+
+" Neovim hands over output in arbitrary chunks, where the last item of
+" `data` is an incomplete line that continues in the next chunk. At the end
+" of the output, `data` is [''], and whatever is left is a line of its own.
+func! s:OnNvimOutput(name, Callback, job, data, event)
+  if a:data == ['']
+    if s:partial_lines[a:name] != ""
+      let line = s:partial_lines[a:name]
+      let s:partial_lines[a:name] = ""
+      call a:Callback(0, line)
+    endif
+    return
+  endif
+  let lines = copy(a:data)
+  let lines[0] = s:partial_lines[a:name] . lines[0]
+  let s:partial_lines[a:name] = remove(lines, -1)
+  for line in lines
+    call a:Callback(0, line)
+  endfor
+endf
+
+func! s:OnOutput(generation, channel, line)
+  if a:line != ""
+    call s:OnData(a:generation, json_decode(a:line))
+  endif
+endf
+
+func! s:OnData(generation, data)
+  " Ignore anything still arriving from a cancelled command.
+  if a:generation != s:active
+    return
+  endif
+
+  if get(a:data, 'reset', 0)
+    let s:entries = []
+    call s:EntriesChanged()
+    if s:QuickfixCurrent()
+      call s:QuickfixSet('r', {'items': []})
+    else
+      call s:QuickfixNew([])
+    endif
+  endif
+
+  if len(a:data.quickfix)
+    let was_empty = s:QuickfixEmpty()
+    if s:merging
+      for entry in a:data.quickfix
+        let s:run_keys[entry.key] = 1
+      endfor
+    endif
+    if s:merging
+      call s:MergeEntries(a:data.quickfix)
+    else
+      call extend(s:entries, a:data.quickfix)
+      call s:EntriesChanged(a:data.quickfix)
+      call s:QuickfixSet('a', {'items': s:Flatten(a:data.quickfix)})
+    endif
+    let s:count += len(a:data.quickfix)
+    call s:SetStatus("`" . s:running . "`: running, " . s:count . " messages")
+    if was_empty
+      copen
+      wincmd p
+    endif
+  endif
+
+  if has_key(a:data, 'message')
+    let s:active = -1
+    let s:snapshot = get(a:data, 'snapshot', "")
+    if len(get(a:data, 'removed', []))
+      call s:RemoveEntries(a:data.removed)
+    endif
+    if get(a:data, 'sort', 0)
+      call s:SortEntries()
+    endif
+    if has_key(a:data, 'tests')
+      call s:RemoveEntries(s:StaleTests(a:data.tests, s:run_keys))
+      let s:snapshot = ""
+    endif
+    call s:RecordStats(a:data)
+    call s:SetStatus(a:data.message)
+    echom a:data.message
+    if s:QuickfixEmpty()
+      cclose
+    endif
+  endif
+endf
+
+" If the script exits without sending its final message, it must have
+" crashed, so say so instead of leaving the status at "running".
+func! s:OnExit(generation, ...)
+  if a:generation != s:active
+    return
+  endif
+  let s:active = -1
+  let s:snapshot = ""
+  call s:SetStatus("`" . s:running . "` exited unexpectedly")
+  echom s:status
+endf
+
+" Checking on save
+"
+" With g:cargo_check_on_save, writing a rust file runs `cargo check` in the
+" background. Saves that follow each other within g:cargo_check_delay
+" milliseconds are checked once, after the last one, and a check that's
+" still running when the next one starts is cancelled. Commands started by
+" hand are never cancelled for a check.
+let s:check_timer = -1
+let s:checking = 0
+
+func! s:OnSave(file)
+  if !get(g:, 'cargo_check_on_save', 0) || !s:UseAsync() || !has('timers')
+    return
+  endif
+  if s:check_timer != -1
+    call timer_stop(s:check_timer)
+  endif
+  let s:check_timer = timer_start(get(g:, 'cargo_check_delay', 300), function('s:Check', [a:file]))
+endf
+
+func! s:Check(file, timer)
+  let s:check_timer = -1
+  if s:active != -1 && !s:checking
+    return
+  endif
+  call s:StartCommand("cargo", "cargo.py", "check", a:file, s:Options([]), "background")
+endf
+
+augroup cargo_check_on_save
+  autocmd!
+  autocmd BufWritePost *.rs call s:OnSave(expand('<afile>:p'))
+augroup END
+
+" Formatting
+"
+" :CargoFormat formats the current buffer with rustfmt (see rustfmt.py),
+" and with g:cargo_format_on_save, writing a rust file formats the lines
+" that changed since it was last written. The python side works on a copy
+" of the buffer in the background, and sends back only the lines that
+" rustfmt changed, which are then changed in the buffer. That keeps the
+" cursor and the marks where they were, and the formatting is a change of
+" its own that can be undone. The result is dropped if the buffer has been
+" changed in the meantime. After formatting on save, the file is written
+" again, if anything changed.
+let s:format_id = 0
+let s:format_requests = {}
+let s:format_writing = 0
+
+func! CargoFormat()
+  call s:Format(bufnr('%'), v:null, 0)
+endf
+
+" Before the file is written, the version on disk is kept to compare the
+" buffer with.
+let s:format_previous = {}
+
+func! s:OnFormatPre(bufnr, file)
+  if s:format_writing || !get(g:, 'cargo_format_on_save', 0)
+    return
+  endif
+  let s:format_previous[a:bufnr] = []
+  if get(g:, 'cargo_format_ranges', 1) && filereadable(a:file)
+    let s:format_previous[a:bufnr] = readfile(a:file)
+  endif
+endf
+
+func! s:OnFormatPost(bufnr)
+  if s:format_writing || !has_key(s:format_previous, a:bufnr)
+    return
+  endif
+  let previous = remove(s:format_previous, a:bufnr)
+  call s:Format(a:bufnr, empty(previous) ? v:null : previous, 1)
+endf
+
+func! s:Format(bufnr, previous, write)
+  let options = {'text': getbufline(a:bufnr, 1, '$')}
+  if a:previous isnot v:null
+    let options.previous = a:previous
+  endif
+  let file = fnamemodify(bufname(a:bufnr), ':p')
+  let s:format_id += 1
+  let id = "format:" . s:format_id
+  let s:format_requests[id] = {'bufnr': a:bufnr, 'tick': getbufvar(a:bufnr, 'changedtick'), 'write': a:write}
+
+  if s:UseAsync() && s:StartServer()
+    call s:Send({'id': id, 'method': 'run', 'tool': 'rustfmt', 'command': 'format',
+          \ 'file': file, 'cwd': getcwd(), 'options': options})
+    return
+  endif
+  let output = system("python " . s:plugin_path . "/rustfmt.py format " . shellescape(file) . " " . shellescape(getcwd()), json_encode(options))
+  try
+    let data = json_decode(output)
+  catch
+    echom "rustfmt.py failed: " . output
+    return
+  endtry
+  let data.id = id
+  call s:OnFormatted(data)
+endf
+
+func! s:OnFormatted(data)
+  if !has_key(s:format_requests, a:data.id)
+    return
+  endif
+  let request = remove(s:format_requests, a:data.id)
+  if get(a:data, 'failed', 0)
+    echom a:data.message
+    return
+  endif
+  let edits = get(a:data, 'edits', [])
+  if empty(edits) || !bufloaded(request.bufnr) || getbufvar(request.bufnr, 'changedtick') != request.tick
+    return
+  endif
+
+  " From the bottom up, so that the line numbers of the edits still to
+  " make don't change.
+  for [start, end, lines] in reverse(edits)
+    let common = min([end - start, len(lines)])
+    if common > 0
+      call setbufline(request.bufnr, start + 1, lines[: common - 1])
+    endif
+    if len(lines) > common
+      call appendbufline(request.bufnr, start + common, lines[common :])
+    elseif end > start + common
+      call deletebufline(request.bufnr, start + common + 1, end)
+    endif
+  endfor
+
+  let windows = win_findbuf(request.bufnr)
+  if request.write && !empty(windows)
+    let s:format_writing = 1
+    try
+      call win_execute(windows[0], 'silent update')
+    finally
+      let s:format_writing = 0
+    endtry
+  endif
+endf
+
+augroup cargo_format_on_save
+  autocmd!
+  autocmd BufWritePre *.rs call s:OnFormatPre(str2nr(expand('<abuf>')), expand('<afile>:p'))
+  autocmd BufWritePost *.rs call s:OnFormatPost(str2nr(expand('<abuf>')))
+augroup END
+
+" Stats
+"
+" With g:cargo_stats, each command reports how long its phases took (see
+" stats.py), and :CargoStats shows the last runs. With g:cargo_stats_log,
+" the runs are also appended to that file, and :CargoStats shows the runs
+" from it instead, including the ones from other vim sessions.
+let s:stats = []
+
+func! s:RecordStats(data)
+  if has_key(a:data, 'stats')
+    call add(s:stats, json_encode(a:data.stats))
+    if len(s:stats) > 100
+      call remove(s:stats, 0)
+    endif
+  endif
+endf
+
+func! CargoStats(...)
+  let cmd = "python " . s:plugin_path . "/stats.py " . get(a:000, 0, 10)
+  let log = get(g:, 'cargo_stats_log', '')
+  if log != ""
+    let output = system(cmd . " " . shellescape(expand(log)))
+  else
+    let output = system(cmd, join(s:stats, "\n") . "\n")
+  endif
+  if output == ""
+    echo "No stats yet, see g:cargo_stats"
+  else
+    echo substitute(output, '\n$', '', '')
+  endif
+endf
+
+func! s:SetStatus(status)
+  let s:status = a:status
+  redrawstatus
+endf
+
+func! s:CompleteScope(lead, line, position)
+  return filter(["buffers", "modified"], 'v:val =~# "^" . a:lead')
 endf
 
-com! -nargs=* CargoBuild call RunCargoCommand("build")
-com! -nargs=* CargoTest call RunCargoCommand("test")
+com! -nargs=? -complete=customlist,s:CompleteScope CargoBuild call RunCargoCommand("build", <f-args>)
+com! -nargs=? -complete=customlist,s:CompleteScope CargoTest call RunCargoCommand("test", <f-args>)
+com! -nargs=? -complete=customlist,s:CompleteScope CargoCheck call RunCargoCommand("check", <f-args>)
+com! -nargs=? -complete=customlist,s:CompleteScope CargoClippy call RunCargoCommand("clippy", <f-args>)
+com! -nargs=? -complete=customlist,s:CompleteScope CargoBench call RunCargoCommand("bench", <f-args>)
+com! -nargs=0 CargoTestHere call CargoTestHere()
+com! -nargs=0 CargoFoldMessages call CargoFoldMessages()
+com! -nargs=0 CargoDiagnosticsHere call CargoDiagnosticsHere()
+com! -nargs=0 CargoNextDiagnostic call CargoJumpDiagnostic(1)
+com! -nargs=0 CargoPrevDiagnostic call CargoJumpDiagnostic(-1)
+com! -nargs=? CargoStats call CargoStats(<f-args>)
+com! -nargs=0 CargoFormat call CargoFormat()
 
-com! -nargs=* BlazeBuild call RunBlazeCommand("build")
-com! -nargs=* BlazeTest call RunBlazeCommand("test")
+com! -nargs=? -complete=customlist,s:CompleteScope BlazeBuild call RunBlazeCommand("build", <f-args>)
+com! -nargs=? -complete=customlist,s:CompleteScope BlazeTest call RunBlazeCommand("test", <f-args>)
+com! -nargs=0 BlazeTestHere call BlazeTestHere()
@@ -1,4 +1,3 @@
-
 #   cargo.py
 #
 #   Author:     Colin Merkel
@@ -7,79 +6,258 @@
 #   cargo.py runs rust's package manager `cargo`, and outputs the build results
 #   in a format that vim can understand for the quickfix bar.
 
-import subprocess
-import json
 import os
+import signal
+import subprocess
 import sys
 
+import builds
+import jobs
 import parse
+import results
+import roots
+import stats
 
-def finish(output):
-    sys.stdout.write(json.dumps(output))
-    sys.exit(0)
-
-def error(reason):
-    finish({
-        "message": reason,
-        "quickfix": []
-    })
-
-def transform_relative_path(cargo_path):
-    return parse.transform_relative_path(cargo_path, CARGO_DIR, CWD)
-
-try:
-    COMMAND = sys.argv[1]
-    FILE = sys.argv[2]
-    CWD = sys.argv[3]
-# Sometimes not enough parameters are passed in, which means that the
-# user tried to run `cargo build` on an empty buffer, or something
-# like that.
-except IndexError:
-    error("Can't find Cargo.toml, is this a cargo project?")
-
-# Find the root directory of the project, where Cargo.toml is located.
-CARGO_DIR = os.path.dirname(FILE)
-while not os.path.isfile(CARGO_DIR + "/Cargo.toml"):
-    parent_directory = os.path.dirname(CARGO_DIR)
-    # Make sure we haven't reached the top level directory.
-    if parent_directory == CARGO_DIR:
-        error("Can't find Cargo.toml, is this a cargo project?")
-    CARGO_DIR = parent_directory
-
-
-try:
-    stdout = subprocess.check_output(
-            ["cargo", COMMAND, "--message-format=json"],
-            # If you don't provide this option, it'll end up
-            # emitting some data to the screen.
-            stderr=open(os.devnull, 'w'),
-            cwd=CARGO_DIR
-    )
-# It's necessary to catch this error because rust will
-# intentionally return exit code > 0 when the build/test
-# fails, but it'll still output the correct info.
-except subprocess.CalledProcessError as e:
-    stdout = e.output
-
-quickfix = []
-try:
-    errors, warnings = parse.parse_command_output(
-        COMMAND,
-        str(stdout),
-        transform_relative_path
+# run runs `cargo COMMAND` for the project containing `file_path` and
+# returns the result for vim. If `emit` is given, every batch of messages
+# is passed to it as soon as cargo reports it, and the returned quickfix
+# list is left empty since everything has been sent already. `options`
+# are the plugin settings from vim:
+#
+#   merge_duplicates: drop a message that was already reported at
+#                     another level, e.g. as an error and as a warning.
+#   snapshot:         the snapshot (see snapshots.py) that vim is showing,
+#                     so that only the changes need to be sent.
+#   files:            build the packages of all of these files instead of
+#                     just `file_path`, or of the files modified in git
+#                     if it's "git".
+#   parallel:         how many workspaces to build at the same time.
+#   test_json:        have libtest report the test results as JSON, when
+#                     the toolchain allows it (see libtest_json).
+#   max_messages:     show at most this many warnings (see
+#                     results.Collector). Errors are all shown, and cargo
+#                     always runs to the end.
+#   build_cache:      replay the messages of builds of unchanged trees
+#                     (see builds.py).
+#   tests:            only run these tests of `file_path`, see test_args.
+#                     Vim merges the results into the list it's showing,
+#                     so the response says which tests were run, and the
+#                     failures say which target they were run in.
+#   stats:            return how long each phase of the command took, see
+#                     stats.py.
+#   stats_log:        append those numbers to this file.
+#   output:           write the result to this file instead of stdout.
+#   package_scope:    only build the package that owns each file, and the
+#                     target in it where that can be told (see
+#                     roots.find_cargo_package), instead of everything
+#                     cargo would build in the package's directory.
+def run(command, file_path, cwd, emit=None, job=None, options=None):
+    options = options or {}
+    recorder = stats.start(options)
+    tests = options.get("tests") if command in parse.TEST_COMMANDS else None
+    files = options.get("files") or [os.path.join(cwd, file_path)]
+
+    # The packages in a workspace share the target directory, and cargo
+    # only builds one of them at a time, so they're built one after the
+    # other. Separate workspaces are built in parallel.
+    workspaces = {}
+    scopes = {}
+    with recorder.phase("roots"):
+        if tests is not None:
+            files = [os.path.join(cwd, file_path)]
+        elif files == "git":
+            files = [f for f in roots.modified_files(cwd) if f.endswith(".rs")]
+
+        for f in files:
+            dirs = roots.find_cargo_dirs(f)
+            if dirs is None:
+                continue
+            cargo_dir, workspace_dir = dirs
+            scope = None
+            if options.get("package_scope"):
+                scope = roots.find_cargo_package(f, workspace_dir)
+            packages = workspaces.setdefault(workspace_dir, [])
+            if cargo_dir not in packages:
+                packages.append(cargo_dir)
+                scopes[cargo_dir] = scope
+            elif scope is not None and scopes[cargo_dir] != scope:
+                # Files in different targets of the package need all of it.
+                scopes[cargo_dir] = (scope[0], None)
+
+    if not workspaces:
+        return results.result("Can't find Cargo.toml, is this a cargo project?")
+
+    if job is None:
+        job = jobs.Job()
+    packages = sorted(sum(workspaces.values(), []))
+    collector = results.Collector(
+        "cargo:%s:%s:%s" % (",".join(packages), cwd, command),
+        options,
+        emit,
+        recorder
     )
-except parse.CargoParseError as e:
-    error(str(e))
-
-reason = "`cargo %s`: success" % COMMAND
-if len(errors) > 0:
-    reason = "`cargo %s` failed, check quickfix" % COMMAND
-    quickfix = errors
-elif len(warnings) > 0:
-    reason = "`cargo %s` succeeded with warnings, check quickfix" % COMMAND
-    quickfix = warnings
-
-finish({
-    "message": reason,
-    "quickfix": [m.render() for m in quickfix]
-})
+
+    def build(workspace_dir, package_dirs):
+        # cargo reports paths relative to the workspace root, even when
+        # it's run from inside one of the workspace members.
+        def transform_relative_path(cargo_path):
+            return parse.transform_relative_path(cargo_path, workspace_dir, cwd)
+        transform_relative_path = recorder.timed("paths", transform_relative_path)
+
+        for cargo_dir in package_dirs:
+            argv = ["cargo", command]
+            scope = scopes[cargo_dir]
+            if scope is not None:
+                package, target = scope
+                argv += ["-p", package]
+                # A change to a library can break its tests anywhere in the
+                # package, so only builds are narrowed down to the target.
+                if target is not None and command in parse.BUILD_COMMANDS:
+                    argv += target
+            test_argv = []
+            test_target = None
+            if tests is not None:
+                target, test_filter, exact = test_args(files[0], cargo_dir, tests)
+                argv += target
+                test_target = _test_target(cargo_dir, target)
+                test_argv += [test_filter] if test_filter else []
+                test_argv += ["--exact"] if exact else []
+            if command in parse.TEST_COMMANDS and options.get("test_json") and libtest_json(cargo_dir):
+                test_argv += ["-Z", "unstable-options", "--format", "json"]
+            argv.append("--message-format=json")
+            if test_argv:
+                argv += ["--"] + test_argv
+
+            # Builds of a workspace whose files haven't changed are replayed
+            # from builds.py.
+            cache = None
+            if command in parse.BUILD_COMMANDS and options.get("build_cache"):
+                with recorder.phase("cache"):
+                    paths, extra = builds.cargo_inputs(workspace_dir)
+                    cache = builds.Build(paths, argv + [cargo_dir, cwd] + extra)
+                    cached = cache.cached()
+                if cached is not None:
+                    recorder.count("cached_builds")
+                    collector.add(cached)
+                    continue
+
+            status = {}
+            lines = recorder.lines(job.lines(argv, cargo_dir, status))
+            batches = recorder.iterate("parse", parse.iter_command_output(
+                command,
+                lines,
+                transform_relative_path,
+                recorder
+            ))
+            for batch in batches:
+                if test_target is not None:
+                    parse.set_test_target(batch, test_target)
+                collector.add(batch)
+                if cache is not None:
+                    cache.add(batch)
+            if cache is not None and not job.cancelled:
+                with recorder.phase("cache"):
+                    cache.finish(status["returncode"])
+
+    try:
+        jobs.parallel(
+            [
+                lambda w=w, p=p: build(w, p)
+                for w, p in sorted(workspaces.items())
+            ],
+            options.get("parallel", 4)
+        )
+    except parse.CargoParseError as e:
+        return results.result(str(e))
+
+    if job.cancelled:
+        return results.result("`cargo %s` was cancelled" % command)
+
+    response = collector.finish("cargo", command, merged=len(packages) > 1)
+    if tests is not None:
+        target, test_filter, exact = test_args(files[0], packages[0], tests)
+        response["tests"] = {
+            "filter": test_filter,
+            "exact": exact,
+            "target": _test_target(packages[0], target),
+        }
+    return stats.finish(recorder, response, "cargo", command, cwd, options)
+
+# test_args maps `file_path` and the tests in it to the cargo arguments that
+# run just those tests. `tests` has the `path` of the test function or
+# module inside the file, e.g. ["tests", "it_works"], and whether it's
+# `exact`, i.e. a single function. The file's own module path comes from
+# where it is in the package, since cargo reports test names relative to
+# the crate root. It returns the target arguments, the test filter and
+# whether the filter is exact.
+def test_args(file_path, package_dir, tests):
+    parts = os.path.relpath(file_path, package_dir).split(os.sep)
+    parts[-1] = os.path.splitext(parts[-1])[0]
+
+    target = []
+    modules = []
+    if parts[0] == "tests" and len(parts) == 2:
+        target = ["--test", parts[1]]
+    elif parts[0] == "src" and len(parts) > 1:
+        if parts[1:] == ["lib"]:
+            target = ["--lib"]
+        elif parts[1:] == ["main"]:
+            target = ["--bins"]
+        elif parts[1] == "bin" and len(parts) > 2:
+            target = ["--bin", parts[2]]
+        else:
+            # Files in src/ other than the crate roots are modules, and could
+            # belong to any of the targets, so all of them are run.
+            modules = parts[1:]
+            if modules[-1] == "mod":
+                modules.pop()
+
+    path = modules + list(tests.get("path", []))
+    return target, "::".join(path), bool(tests.get("exact")) and len(path) > 0
+
+# _test_target names the tests of a targeted run: the package, and the
+# target arguments from test_args. Vim only takes failures off the list
+# that were reported by a run of the same target.
+def _test_target(package_dir, target):
+    return " ".join([package_dir] + target)
+
+# libtest_json returns whether the tests in `cargo_dir` can report their
+# results as JSON. libtest only accepts `--format json` on nightly, so
+# elsewhere the text output is parsed instead. The answer is remembered,
+# since the server asks for every run.
+_libtest_json = {}
+
+def libtest_json(cargo_dir):
+    if cargo_dir not in _libtest_json:
+        try:
+            version = subprocess.check_output(["rustc", "--version"], cwd=cargo_dir)
+        except (OSError, subprocess.CalledProcessError):
+            version = b""
+        _libtest_json[cargo_dir] = (
+            b"-nightly" in version or
+            b"-dev" in version or
+            os.environ.get("RUSTC_BOOTSTRAP") == "1"
+        )
+    return _libtest_json[cargo_dir]
+
+def main(argv):
+    args, options = jobs.parse_args(argv)
+    # Sometimes not enough parameters are passed in, which means that the
+    # user tried to run `cargo build` on an empty buffer, or something
+    # like that.
+    if len(args) < 3:
+        return results.result("Can't find Cargo.toml, is this a cargo project?")
+
+    # Vim stops the job with SIGTERM when a new command is started. Pass
+    # that on to cargo, which would otherwise keep building in the
+    # background.
+    job = jobs.Job()
+    def cancel(signum, frame):
+        job.cancel()
+        sys.exit(1)
+    signal.signal(signal.SIGTERM, cancel)
+
+    return run(args[0], args[1], args[2], results.emit if options.get("stream") else None, job, options)
+
+if __name__ == '__main__':
+    results.write(main(sys.argv), jobs.parse_args(sys.argv)[1])
@@ -0,0 +1,189 @@
+#
+#   jobs.py
+#
+#   jobs.py runs the build tools (cargo, bazel, rustfmt) as cancellable
+#   subprocesses, so that both the one-shot scripts and the server can stop
+#   a build that has been superseded by a newer one.
+
+import io
+import json
+import os
+import signal
+import subprocess
+import threading
+import time
+
+# parse_args splits the command line of cargo.py and bazel.py into the
+# positional arguments and the options. Vim passes options as a JSON object
+# in `--options={...}`, and `--stream` turns on streaming mode.
+def parse_args(argv):
+    args = []
+    options = {}
+    for arg in argv[1:]:
+        if arg == "--stream":
+            options["stream"] = True
+        elif arg.startswith("--options="):
+            options.update(json.loads(arg[len("--options="):]))
+        else:
+            args.append(arg)
+    return args, options
+
+class Job(object):
+    def __init__(self):
+        self.processes = []
+        self.cancelled = False
+
+    # lines starts `argv` and yields the lines of its output as soon as
+    # they're written. A failing build still outputs the correct info, so
+    # the exit code isn't an error, but if `status` (a dict) is given, it's
+    # stored there as "returncode" once the command has exited, or None if
+    # it was stopped. A job can run several commands, also at the same
+    # time from different threads. Closing the generator stops the command.
+    def lines(self, argv, cwd, status=None):
+        if status is None:
+            status = {}
+        status["returncode"] = None
+        if self.cancelled:
+            return
+
+        process = self.start(argv, cwd, subprocess.PIPE)
+        try:
+            # Iterating over the pipe directly would read ahead in large
+            # chunks, so use readline to get each line as it arrives.
+            for line in iter(process.stdout.readline, b''):
+                yield line.decode('utf-8', 'replace')
+            status["returncode"] = process.wait()
+        finally:
+            # If the caller stops reading early, the command is stopped
+            # rather than left blocked on a full pipe.
+            if process.poll() is None:
+                terminate(process)
+            process.stdout.close()
+            process.wait()
+
+    # communicate runs `argv` with `text` as its input, and returns its exit
+    # code, output and error output, or None if the job was cancelled.
+    def communicate(self, argv, cwd, text):
+        if self.cancelled:
+            return None
+
+        process = self.start(argv, cwd, subprocess.PIPE, subprocess.PIPE, subprocess.PIPE)
+        stdout, stderr = process.communicate(text.encode('utf-8'))
+        if self.cancelled:
+            return None
+        return (
+            process.returncode,
+            stdout.decode('utf-8', 'replace'),
+            stderr.decode('utf-8', 'replace')
+        )
+
+    # start starts `argv` as part of the job, and returns the process.
+    # Its output is discarded, unless `stdout` or `stderr` say otherwise.
+    def start(self, argv, cwd, stdout=None, stdin=None, stderr=None):
+        devnull = open(os.devnull, 'w')
+        process = subprocess.Popen(
+                argv,
+                stdin=stdin,
+                stdout=stdout or devnull,
+                # If you don't provide this option, it'll end up
+                # emitting some data to the screen.
+                stderr=stderr or devnull,
+                cwd=cwd,
+                # Run in a separate process group so that cancel() can
+                # stop the compiler processes too.
+                preexec_fn=os.setsid
+        )
+        self.processes.append(process)
+        return process
+
+    def cancel(self):
+        self.cancelled = True
+        for process in self.processes:
+            if process.poll() is None:
+                terminate(process)
+
+# terminate stops `process`, and anything it started.
+def terminate(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except OSError:
+        pass
+
+# follow yields the lines of the file at `path` as `process` writes them,
+# until it exits. Like with Job.lines, closing the generator stops the
+# process.
+def follow(path, process, interval=0.1):
+    f = None
+    partial = ""
+    try:
+        while True:
+            # Everything written before the process exited is read after
+            # this check.
+            running = process.poll() is None
+            if f is None:
+                try:
+                    f = io.open(path, encoding='utf-8', errors='replace')
+                except (IOError, OSError):
+                    if not running:
+                        return
+                    time.sleep(interval)
+                    continue
+
+            chunk = f.read()
+            if chunk:
+                lines = (partial + chunk).split("\n")
+                partial = lines.pop()
+                for line in lines:
+                    yield line
+            elif not running:
+                break
+            else:
+                time.sleep(interval)
+
+        if partial:
+            yield partial
+    finally:
+        if process.poll() is None:
+            terminate(process)
+        if f is not None:
+            f.close()
+
+# parallel calls each of `functions` on a pool of at most `limit` threads,
+# and returns their results in order. If any of them raises an exception,
+# it's raised again once they're all done.
+def parallel(functions, limit):
+    if len(functions) == 1:
+        return [functions[0]()]
+
+    results = [None] * len(functions)
+    errors = []
+    pending = list(enumerate(functions))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                i, function = pending.pop(0)
+            try:
+                results[i] = function()
+            except Exception as e:
+                errors.append(e)
+
+    threads = [
+        threading.Thread(target=worker)
+        for _ in range(max(1, min(limit, len(functions))))
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # Joining with a timeout lets signal handlers (like the SIGTERM
+        # handler of the scripts) run in the meantime.
+        while thread.is_alive():
+            thread.join(0.1)
+
+    if errors:
+        raise errors[0]
+    return results
@@ -9,20 +9,66 @@
 #   regular old text. So we need to parse the text directly in order to put
 #   the output into the quickfix bar in vim. This module parses the text.
 
+import hashlib
+import io
+import itertools
 import json
 import os
 import re
 
+# orjson decodes cargo's output several times faster than the json module,
+# so it's used when it's installed.
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
 class CargoParseError(Exception):
     pass
 
 # transform_relative_path takes a file path relative to the
 # cargo directory and transforms it into a path relative to the
 # CWD inside of vim, which is passed as a command line argument.
+# Files of dependencies and the standard library are reported with
+# absolute paths, which end up relative to the CWD as well, e.g.
+# "../flags/src/parse.rs".
 def transform_relative_path(cargo_path, cargo_dir, working_dir):
-    return os.path.relpath("%s/%s" % (cargo_dir, cargo_path), working_dir)
-
+    return os.path.relpath(os.path.join(cargo_dir, cargo_path), working_dir)
+
+# Filenames are shared between all the messages that point into the same
+# file, rather than each message holding its own copy.
+_filenames = {}
+
+def _intern(filename):
+    return _filenames.setdefault(filename, filename)
+
+# _Resolver transforms each path that a build reports only once, since the
+# same few files come up over and over, and interns the result.
+class _Resolver(object):
+    def __init__(self, path_transformer):
+        self.path_transformer = path_transformer
+        self.paths = {}
+
+    def __call__(self, path):
+        resolved = self.paths.get(path)
+        if resolved is None:
+            resolved = _intern(self.path_transformer(path))
+            self.paths[path] = resolved
+        return resolved
+
+def _resolver(path_transformer):
+    if isinstance(path_transformer, _Resolver):
+        return path_transformer
+    return _Resolver(path_transformer)
+
+# Message is a single diagnostic. A diagnostic from the compiler is made up
+# of a top level message, with the source snippets, notes and help hints
+# that belong to it as its children. Children point at the same location
+# as their parent, unless they have a location of their own.
 class Message(object):
+    __slots__ = ("text", "filename", "line", "column", "level", "code", "test", "parent", "children")
+
     def __init__(self):
         self.text = ""
         self.filename = ""
@@ -31,226 +77,706 @@ class Message(object):
 
         # self.level can either be "warning" or "error".
         self.level = 'error'
+        # The compiler's error code, e.g. "E0308", if it has one.
+        self.code = None
+        # For a failed test, its `name` and the `target` it was run in, if
+        # that's known (see cargo.run), so that vim can tell which failures
+        # a later run of the test has fixed.
+        self.test = None
+
+        self.parent = None
+        self.children = []
 
     def render(self):
         if self.text is None:
             self.text = ""
 
-        return {
+        rendered = {
             "filename": self.filename,
             "lnum": self.line,
             "text": self.text,
             "type": "W" if self.level == 'warning' else "E",
         }
-
-    def __eq__(self, other):
-        return (
-            self.text == other.text and \
-            self.filename == other.filename and \
-            self.line == other.line and \
-            self.column == other.column
-        )
-
-    def __repr__(self):
-        return "%s:%s || %s" % (self.filename, self.line, self.text)
-
-    def clone(self):
+        if self.test is not None:
+            rendered["test"] = self.test
+        return rendered
+
+    # render_tree renders the message along with its children, which vim
+    # can show either flattened or folded into the top level message. Top
+    # level messages also get their digest, which vim uses to remove them
+    # again when they've been fixed. Vim only folds the top level, so the
+    # children of children are listed after their parent, and vim can
+    # flatten the list without going over it entry by entry.
+    def render_tree(self):
+        rendered = self.render()
+        if self.parent is None:
+            rendered["key"] = self.digest()
+        children = []
+        self._render_descendants(children)
+        if children:
+            rendered["children"] = children
+        return rendered
+
+    def _render_descendants(self, rendered):
+        for c in self.children:
+            rendered.append(c.render())
+            c._render_descendants(rendered)
+
+    # child adds a child message with the given text at the same location.
+    def child(self, text):
         m = Message()
-        m.text = self.text
+        m.text = text
         m.filename = self.filename
         m.line = self.line
         m.column = self.column
         m.level = self.level
+        m.code = self.code
+        m.parent = self
+        self.children.append(m)
         return m
 
+    # key identifies the message, so that messages reported more than once
+    # can be recognized.
+    def key(self):
+        return (self.filename, self.line, self.column, self.level, self.code, self.text)
+
+    # digest is a short, stable id for the message, which stays the same
+    # between runs (unlike hash()).
+    def digest(self):
+        return hashlib.sha1(json.dumps(self.key()).encode('utf-8')).hexdigest()[:16]
+
+    # dump turns the message and its children into plain data, e.g. to
+    # store it as JSON, and load turns that back into a message.
+    def dump(self):
+        return [list(self.key()), [c.dump() for c in self.children]]
+
+    @staticmethod
+    def load(data, parent=None):
+        m = Message()
+        (m.filename, m.line, m.column, m.level, m.code, m.text), children = data
+        m.filename = _intern(m.filename)
+        m.parent = parent
+        m.children = [Message.load(c, m) for c in children]
+        return m
+
+    def __eq__(self, other):
+        return self.key() == other.key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __repr__(self):
+        return "%s:%s || %s" % (self.filename, self.line, self.text)
+
+# flatten yields each of the messages followed by all of its children, in
+# the order that they were reported.
+def flatten(messages):
+    for m in messages:
+        yield m
+        for child in flatten(m.children):
+            yield child
+
+# The cargo commands that only report compiler messages, and the ones that
+# run tests (or benchmarks, which libtest reports the same way) afterwards.
+BUILD_COMMANDS = ("build", "check", "clippy")
+TEST_COMMANDS = ("test", "bench")
+
 def parse_command_output(command, output, path_transformer):
     errors = []
     warnings = []
-    if command == "build":
-        errors, warnings = parse_build_output(output, path_transformer)
-    elif command == "test":
-        errors, _ = parse_build_output(output, path_transformer)
-        if len(errors) == 0:
-            errors = parse_test_output(output, path_transformer)
-    else:
-        raise CargoParseError("No such command: `%s`" % command)
+    for batch in iter_command_output(command, output.split('\n'), path_transformer):
+        for m in flatten(batch):
+            if m.level == 'warning':
+                warnings.append(m)
+            else:
+                errors.append(m)
 
     return _deduplicate_messages(errors), _deduplicate_messages(warnings)
 
+# iter_command_output is the streaming version of parse_command_output. It
+# consumes `lines` lazily (e.g. straight from the cargo pipe) and yields a
+# batch of top level messages as soon as each one can be decoded, so that
+# the caller can show the first error before cargo has finished. If
+# `stats` (see stats.py) is given, the time spent decoding JSON is counted
+# in it.
+def iter_command_output(command, lines, path_transformer, stats=None):
+    if command not in BUILD_COMMANDS + TEST_COMMANDS:
+        raise CargoParseError("No such command: `%s`" % command)
+
+    return _iter_command_output(command, lines, path_transformer, stats)
+
+def _iter_command_output(command, lines, path_transformer, stats):
+    if command in BUILD_COMMANDS:
+        for batch in iter_build_output(lines, path_transformer, stats):
+            yield batch
+        return
+
+    # `cargo test` prints the results of the tests after the JSON build
+    # messages, either as libtest's JSON events or as regular text. The
+    # tests only run if the build succeeded, so warnings are left out.
+    path_transformer = _resolver(path_transformer)
+    decode = _timed_decode(stats)
+    tests = _TestParser(path_transformer)
+    for line in lines:
+        reason = _reason(line)
+        record = None
+        if reason is None:
+            # As in _compiler_messages, a record might not start with its
+            # reason.
+            record = decode(line)
+            if record is not None:
+                reason = record.get("reason")
+        elif reason == "compiler-message":
+            record = decode(line)
+
+        if reason is not None:
+            m = None if record is None else _compiler_message(record, path_transformer)
+            if m is not None and m.level != 'warning':
+                yield [m]
+            continue
+
+        batch = tests.feed(line, record)
+        if batch:
+            yield batch
+
+    batch = tests.finish()
+    if batch:
+        yield batch
+
+def _timed_decode(stats):
+    if stats is None:
+        return _decode
+    return stats.timed("decode", _decode)
+
+# parse_bazel_output returns the top level errors and warnings, with the
+# snippets and hints that belong to them as their children.
 def parse_bazel_output(command, output, path_transformer):
     errors = []
     warnings = []
     if command == "build":
-        errors = parse_bazel_build_output(output, path_transformer)
+        batches = iter_bazel_build_output(output.split("\n"), path_transformer)
+        for m in itertools.chain.from_iterable(batches):
+            if m.level == 'warning':
+                warnings.append(m)
+            else:
+                errors.append(m)
     elif command == "test":
         errors = parse_test_output(output, path_transformer)
 
     return _deduplicate_messages(errors), _deduplicate_messages(warnings)
 
-def parse_bazel_build_output(output, path_transformer):
-    errors = []
+_BAZEL_HEADER = re.compile(r"^\s*(error|warning)(\[E[0-9]+\])?: (.*)")
+_BAZEL_LOCATION = re.compile(r"^\s*--> (.*?):([0-9]+):([0-9]+)")
+# Source lines, with the line number prefixes stripped out, and the help or
+# note hints that follow them.
+_BAZEL_BODY = re.compile(r"^(?:\s*[0-9]*\s*\|(.*)|[\s=]*(?:help|note): (.*))")
+
+# _BazelParser turns rustc's human readable output into messages, going over
+# the output once. In each state, the pattern listed in STATES is tried on
+# the next line, and if it matches, the handler returns the next state. If
+# it doesn't, the current diagnostic is over and the line is tried again as
+# the start of a new one.
+class _BazelParser(object):
+    STATES = {
+        # error[E0425]: cannot find value `asdf1` in this scope
+        "header": (_BAZEL_HEADER, "on_header"),
+        #    --> largetable/largetable_test.rs:209:23
+        "location": (_BAZEL_LOCATION, "on_location"),
+        # 209 |         assert_eq!(0, asdf1);
+        #     = help: items from traits can only be used if the trait is in scope
+        "body": (_BAZEL_BODY, "on_body"),
+    }
+
+    def __init__(self, path_transformer):
+        self.path_transformer = _resolver(path_transformer)
+        self.state = "header"
+        self.message = None
+        self.batch = []
+        self.table = dict(
+            (state, (expr.match, getattr(self, handler)))
+            for state, (expr, handler) in self.STATES.items()
+        )
 
-    lines = iter(output.split("\n"))
-    try:
+    # feed takes the next line, and returns the messages of the diagnostic
+    # that it ended, if any.
+    def feed(self, line):
+        completed = []
         while True:
-            line = next(lines).strip()
-            expr = r"^error(\[E[0-9]+\])?: (.*)"
-            results = re.match(expr, line)
-            if not results:
-                continue
+            match, handler = self.table[self.state]
+            results = match(line)
+            if results:
+                self.state = handler(results)
+                return completed
+            if self.state == "header":
+                return completed
+            # The line isn't part of the diagnostic, so it's over, and the
+            # line is tried again as the start of the next one.
+            completed = self.finish()
+
+    # finish ends the current diagnostic and returns its messages.
+    def finish(self):
+        completed = self.batch
+        self.batch = []
+        self.message = None
+        self.state = "header"
+        return completed
+
+    def on_header(self, results):
+        self.message = Message()
+        self.message.level = results.group(1)
+        if results.group(2):
+            self.message.code = results.group(2)[1:-1]
+        self.message.text = results.group(3).rstrip()
+        return "location"
+
+    def on_location(self, results):
+        self.message.filename = self.path_transformer(results.group(1))
+        self.message.line = int(results.group(2))
+        self.message.column = int(results.group(3))
+        self.batch.append(self.message)
+        return "body"
+
+    def on_body(self, results):
+        snippet, hint = results.groups()
+        if hint is not None:
+            # Following the error is sometimes an informative hint on
+            # where to look for the issue. Append the helpful hint right
+            # after the error text.
+            self.message.child(hint)
+        # Strip out empty lines that take up space in quickfix
+        elif snippet != "":
+            self.message.child(" | %s" % snippet)
+        return "body"
+
+# iter_bazel_build_output yields each rustc diagnostic in `lines`, with the
+# snippets and hints as its children, as soon as the diagnostic is complete.
+def iter_bazel_build_output(lines, path_transformer):
+    parser = _BazelParser(path_transformer)
+    for line in lines:
+        batch = parser.feed(line)
+        if batch:
+            yield batch
 
-            m = Message()
-            m.text = results.group(2)
+    batch = parser.finish()
+    if batch:
+        yield batch
 
-            line = next(lines).strip()
-            expr = r"^--> (.*?):([0-9]+):([0-9]+)"
-            results = re.match(expr, line)
-            if not results:
-                continue
+def parse_bazel_build_output(output, path_transformer):
+    messages = []
+    for batch in iter_bazel_build_output(output.split("\n"), path_transformer):
+        messages.extend(flatten(batch))
+    return messages
 
-            m.filename = path_transformer(results.group(1))
-            m.line = int(results.group(2))
-            m.column = int(results.group(3))
-            errors.append(m)
-
-            # Following the error is sometimes an informative hint
-            # on where to look for the issue. Append the helpful hint
-            # right after the error text.
-            line = next(lines)
-            while line.strip() != "":
-                # Strip out the line number prefixes
-                expr = r"^\s*[0-9]*\s*\|(.*)"
-                results = re.match(expr, line)
-                if not results:
-                    # it may be a help message, try that
-                    expr = r"^([\s=]*)help: (.*)"
-                    results = re.match(expr, line)
-                    if not results:
-                        break
+# bazel's own errors, e.g. about a BUILD file, in its console output.
+_BAZEL_ERROR = re.compile(r"^ERROR: (\S+?):(\d+):(\d+): (.*)")
 
-                    m = m.clone()
-                    m.text = results.group(2)
-                    errors.append(m)
+# iter_build_events yields the messages in bazel's Build Event Protocol
+# events, as written by --build_event_json_file, as soon as each event
+# arrives. The events used are:
+#
+#   progress:       the console output, with rustc's diagnostics and
+#                   bazel's own errors in its stderr.
+#   action:         a failed action (only failed ones are reported), with
+#                   the output of just that action in its stderr file.
+#   testResult:     a test run; the test log is only read if it failed.
+#   aborted:        a target that couldn't be loaded or analyzed.
+#
+# `label_path` returns the BUILD file of a label, where messages about a
+# target without a location of their own are put.
+def iter_build_events(events, path_transformer, label_path):
+    path_transformer = _resolver(path_transformer)
+    console = _BazelParser(path_transformer)
+    partial = ""
+    for event in events:
+        stderr = event.get("progress", {}).get("stderr")
+        if stderr:
+            lines = (partial + stderr).split("\n")
+            partial = lines.pop()
+            for line in lines:
+                batch = console.feed(line) + _bazel_error(line, path_transformer)
+                if batch:
+                    yield batch
+            continue
 
-                    line = next(lines)
-                    continue
-                    
+        batch = console.finish()
+        if "action" in event:
+            batch += _failed_action(event["action"], path_transformer, label_path)
+        elif "testResult" in event:
+            batch += _test_result(event, path_transformer, label_path)
+        elif "aborted" in event:
+            batch += _aborted(event, label_path)
+        if batch:
+            yield batch
+
+    batch = console.feed(partial) + console.finish()
+    if batch:
+        yield batch
+
+# decode_events decodes the lines of a --build_event_json_file, skipping
+# any that aren't complete events. See iter_command_output for `stats`.
+def decode_events(lines, stats=None):
+    decode = _timed_decode(stats)
+    for line in lines:
+        event = decode(line)
+        if isinstance(event, dict):
+            yield event
+
+def _bazel_error(line, path_transformer):
+    results = _BAZEL_ERROR.match(line)
+    # Failed actions are reported with their own output.
+    if results is None or " failed: (" in results.group(4):
+        return []
+    m = Message()
+    m.filename = path_transformer(results.group(1))
+    m.line = int(results.group(2))
+    m.column = int(results.group(3))
+    m.text = results.group(4)
+    return [m]
+
+def _event_label(event):
+    for value in event.get("id", {}).values():
+        if isinstance(value, dict) and "label" in value:
+            return value["label"]
+    return None
+
+def _target_message(label, text, label_path):
+    m = Message()
+    m.filename = _intern(label_path(label) or "")
+    m.text = text
+    return m
 
-                # Strip out empty lines that take up space in quickfix
-                if results.group(1) == "":
-                    line = next(lines)
-                    continue
+# _read_output returns the lines of a file that an event refers to, which
+# bazel gives as a file:// URI when it's on the local disk.
+def _read_output(output):
+    uri = output.get("uri", "")
+    if not uri.startswith("file://"):
+        return []
+    try:
+        with io.open(uri[len("file://"):], encoding='utf-8', errors='replace') as f:
+            return f.read().split("\n")
+    except (IOError, OSError):
+        return []
+
+def _failed_action(action, path_transformer, label_path):
+    if action.get("success"):
+        return []
+    lines = _read_output(action.get("stderr", {}))
+    messages = list(itertools.chain.from_iterable(
+        iter_bazel_build_output(lines, path_transformer)
+    ))
+    if not messages:
+        label = action.get("label", "")
+        messages = [_target_message(label, "%s: %s failed (exit code %s)" % (
+            label,
+            action.get("type", "action"),
+            action.get("exitCode", "?")
+        ), label_path)]
+    return messages
 
-                m = m.clone()
-                m.text = " | %s" % results.group(1)
-                errors.append(m)
-                line = next(lines)
+def _test_result(event, path_transformer, label_path):
+    result = event["testResult"]
+    status = result.get("status", "")
+    if status in ("PASSED", "FLAKY", ""):
+        return []
 
-    except StopIteration:
-        pass
+    messages = []
+    for output in result.get("testActionOutput", []):
+        if output.get("name") == "test.log":
+            lines = _read_output(output)
+            messages = list(itertools.chain.from_iterable(
+                iter_test_output(lines, path_transformer)
+            ))
+    if not messages:
+        label = _event_label(event)
+        text = "%s: %s" % (label, status)
+        if "testAttemptDurationMillis" in result:
+            text += " in %.1fs" % (int(result["testAttemptDurationMillis"]) / 1000.0)
+        messages = [_target_message(label, text, label_path)]
+    return messages
 
-    return errors
+# The reasons a target is aborted for because of a problem with it, rather
+# than e.g. because a dependency failed.
+_ABORTED_REASONS = ("LOADING_FAILURE", "ANALYSIS_FAILURE")
+
+def _aborted(event, label_path):
+    label = _event_label(event)
+    aborted = event["aborted"]
+    if aborted.get("reason") not in _ABORTED_REASONS:
+        return []
+    text = aborted.get("description") or aborted.get("reason", "aborted")
+    if label is None:
+        m = Message()
+        m.text = text
+        return [m]
+    return [_target_message(label, "%s: %s" % (label, text), label_path)]
 
 def parse_build_output(output, path_transformer):
     errors = []
     warnings = []
-    skipped_build_due_to_fresh_cache = True
-    for line in output.split('\n'):
-        try:
-            cargo_message = json.loads(line)
-        except ValueError:
-            continue
-
-        if cargo_message['reason'] == 'compiler-artifact':
-            if not cargo_message['fresh']:
-                skipped_build_due_to_fresh_cache = False
-        if cargo_message['reason'] != "compiler-message":
-            continue
-
-        for msg in cargo_message['message']['spans']:
-            message = Message()
-            message.filename = path_transformer(msg['file_name'])
-            message.line = msg['line_start']
-
-            # Sometimes it's the case that the error occurred inside macro-expanded code.
-            # In that case, this filename isn't the one we want. We want the data from
-            # inside the expansion, which maps back to the original code.
-            if message.filename.startswith('<'):
-                message.filename = msg['expansion']['span']['file_name']
-                message.line = msg['expansion']['span']['line_start']
-
-            message.text = msg['label']
-            message.level = cargo_message['message']['level']
-            # For some reason, warnings are not written to the 'label'. So we
-            # need to read them from 'message'->'message' instead.
-            if not message.text:
-                message.text = cargo_message['message']['message']
-            message.column = msg['column_start']
-
+    for batch in iter_build_output(output.split('\n'), path_transformer):
+        for message in flatten(batch):
             if message.level == 'warning':
                 warnings.append(message)
             else:
                 errors.append(message)
 
-    if skipped_build_due_to_fresh_cache:
-        cache_warning = Message()
-        cache_warning.text = "`cargo` skipped build since there were no changes since last build. To force rebuild, update the timestamp on a file (e.g. :w)."
-        warnings.append(cache_warning)
-
     return errors, warnings
 
-def _parse_accumulated_message(text, path_transformer):
-    expr = r"---- ([^\s]+) [^\s]+ ----.+panicked at '(.*)', ([^\:]*):(\d+):?(\d+)?"
-    results = re.match(expr, text)
-    if not results:
-        raise CargoParseError("Can't parse test output: %s" % text)
-
-    m = Message()
-    m.text = "%s %s" % (results.group(1), results.group(2))
-    m.filename = path_transformer(results.group(3))
-    m.line = int(results.group(4))
-    if results.group(5) is not None:
-        m.column = int(results.group(5))
-    return m
+# iter_build_output yields one batch for each `compiler-message` record in
+# the cargo output, in the order cargo emits them (see _compiler_message).
+def iter_build_output(lines, path_transformer, stats=None):
+    path_transformer = _resolver(path_transformer)
+    for cargo_message in _compiler_messages(lines, _timed_decode(stats)):
+        message = _compiler_message(cargo_message, path_transformer)
+        if message is not None:
+            yield [message]
+
+# _decode returns the JSON object on `line`, or None if it isn't one. Lines
+# that can't be JSON are skipped without trying to decode them.
+def _decode(line):
+    if not line.lstrip().startswith("{"):
+        return None
+    try:
+        record = _loads(line)
+    except ValueError:
+        return None
+    if not isinstance(record, dict):
+        return None
+    return record
+
+# cargo writes the `reason` first in every record, so it can be read
+# without decoding the rest. Most of cargo's output (by size) is
+# `compiler-artifact` records listing every file a crate produced, which
+# are never decoded this way.
+_REASON_PREFIX = '{"reason":"'
+
+# _reason returns the reason of the cargo record on `line`, or None if the
+# line isn't one.
+def _reason(line):
+    if not line.startswith(_REASON_PREFIX):
+        return None
+    end = line.find('"', len(_REASON_PREFIX))
+    if end == -1:
+        return None
+    return line[len(_REASON_PREFIX):end]
+
+# _compiler_messages decodes the `compiler-message` records among `lines`,
+# and skips everything else.
+def _compiler_messages(lines, decode=_decode):
+    for line in lines:
+        reason = _reason(line)
+        if reason is None:
+            # cargo always puts the reason first, but other tools that
+            # produce the same records might not.
+            record = decode(line)
+            if record is not None and record.get("reason") == "compiler-message":
+                yield record
+        elif reason == "compiler-message":
+            record = decode(line)
+            if record is not None:
+                yield record
+
+# _user_span follows the macro expansions of `span` back to the code that
+# the user wrote. Spans inside a macro definition point at a pseudo file
+# like `<::std::macros::panic macros>`, or at an absolute path into the
+# standard library or a dependency, and their expansion at the macro call,
+# which may itself be inside another macro.
+def _user_span(span):
+    while _external(span['file_name']) and span.get('expansion'):
+        span = span['expansion']['span']
+    return span
+
+def _external(file_name):
+    return file_name.startswith('<') or os.path.isabs(file_name)
+
+# _compiler_message returns the message for a `compiler-message` record, or
+# None for any other record. Like rustc's own output, the message is shown
+# at its primary span, and the labels of all the spans, followed by the
+# notes and help, are its children.
+def _compiler_message(cargo_message, path_transformer):
+    if cargo_message.get('reason') != "compiler-message":
+        return None
+
+    record = cargo_message['message']
+    spans = record['spans']
+    if not spans:
+        return None
+    primary = _primary_span(spans)
+
+    parent = Message()
+    _locate(parent, primary, path_transformer)
+    parent.text = record['message']
+    parent.level = record['level']
+    if record.get('code'):
+        parent.code = record['code']['code']
+
+    for span in [primary] + [s for s in spans if s is not primary]:
+        if span['label']:
+            _locate(parent.child(span['label']), span, path_transformer)
+    for child in record.get('children') or []:
+        m = parent.child("%s: %s" % (child['level'], child['message']))
+        if child.get('spans'):
+            _locate(m, _primary_span(child['spans']), path_transformer)
+    return parent
+
+# _primary_span returns the span that rustc marks as primary, or the first
+# span if none is.
+def _primary_span(spans):
+    for span in spans:
+        if span.get('is_primary'):
+            return span
+    return spans[0]
+
+def _locate(message, span, path_transformer):
+    span = _user_span(span)
+    message.filename = path_transformer(span['file_name'])
+    message.line = span['line_start']
+    message.column = span['column_start']
 
 # _deduplicate_messages makes sure that duplicate warnings/errors aren't
 # repeated in the quickfix tray. For some reason, this can sometimes happen,
 # and I'm not really sure how to avoid it via cargo flags, so we can just
 # deduplicate here.
 def _deduplicate_messages(messages):
-    seen = {}
-    output = []
-    for m in messages:
-        if str(m) in seen:
-            continue
-        
-        output.append(m)
-        seen[str(m)] = True
-
-    return output
+    deduplicator = Deduplicator()
+    return [m for m in messages if deduplicator.add(m)]
+
+# Deduplicator remembers the messages it has seen, e.g. over a whole
+# streamed build, where a workspace reports the same warning once for each
+# crate that depends on the code. With `merge_levels`, messages that only
+# differ in their level are considered duplicates too, so the same problem
+# isn't listed as both an error and a warning.
+class Deduplicator(object):
+    def __init__(self, merge_levels=False):
+        self.merge_levels = merge_levels
+        self.seen = set()
+
+    # add returns whether `m` is new, and remembers it if so.
+    def add(self, m):
+        key = m.key()
+        if self.merge_levels:
+            key = key[:3] + key[4:]
+        if key in self.seen:
+            return False
+        self.seen.add(key)
+        return True
 
 def parse_test_output(output, path_transformer):
-    lines = [ line.strip() for line in output.split('\n') ]
-    accumulated_message = ""
-    messages = []
+    return list(itertools.chain.from_iterable(
+        iter_test_output(output.split('\n'), path_transformer)
+    ))
+
+# iter_test_output yields the failed tests as soon as each one has been
+# reported. It understands both libtest's JSON events (`--format json`) and
+# its regular text output, where each failure is a block that starts with
+# `---- name stdout ----`.
+def iter_test_output(lines, path_transformer):
+    parser = _TestParser(path_transformer)
     for line in lines:
-        if accumulated_message != "":
-            if line.startswith("----"):
-                messages.append(_parse_accumulated_message(
-                    accumulated_message,
-                    path_transformer
-                ))
-                accumulated_message = line
-            else:
-                accumulated_message += " " + line
+        batch = parser.feed(line, _decode(line))
+        if batch:
+            yield batch
+    batch = parser.finish()
+    if batch:
+        yield batch
+
+# set_test_target records the `target` that the failed tests in `batch`
+# were run in.
+def set_test_target(batch, target):
+    for m in batch:
+        if m.test is not None:
+            m.test["target"] = target
+
+_TEST_HEADER = re.compile(r"^---- (\S+) \S+ ----$")
+# The location that follows `panicked at` in newer versions of rust, where
+# the panic message is on the next lines.
+_PANIC_LOCATION = re.compile(r"^(\S+?):(\d+)(?::(\d+))?:?$")
+# The end of the panic message in older versions of rust, which quote the
+# message and put the location after it.
+_QUOTED_PANIC_LOCATION = re.compile(r"', (\S+?):(\d+)(?::(\d+))?$")
+
+class _TestParser(object):
+    def __init__(self, path_transformer):
+        self.path_transformer = _resolver(path_transformer)
+        # The name and lines of the text block being read.
+        self.name = None
+        self.lines = []
+
+    # feed takes the next line, and `record` if the line is JSON. It
+    # returns the tests that are known to have failed after it.
+    def feed(self, line, record=None):
+        if record is not None:
+            if record.get("type") == "test" and record.get("event") == "failed":
+                return [self._failure(
+                    record.get("name", ""),
+                    record.get("stdout", "").split("\n")
+                )]
+            return []
+
+        line = line.strip()
+        header = _TEST_HEADER.match(line)
+        if header is not None:
+            failed = self.finish()
+            self.name = header.group(1)
+            return failed
+        # The list of failed tests that follows the blocks.
+        if line == "failures:" or line.startswith("test result:"):
+            return self.finish()
+        if self.name is not None:
+            self.lines.append(line)
+        return []
+
+    def finish(self):
+        if self.name is None:
+            return []
+        failed = [self._failure(self.name, self.lines)]
+        self.name = None
+        self.lines = []
+        return failed
+
+    # _failure makes the message for test `name` from its output. Tests
+    # that don't fail with a panic (e.g. a test returning Err) still get a
+    # message, just without a location.
+    def _failure(self, name, lines):
+        lines = [line.strip() for line in lines]
+        m = Message()
+        m.test = {"name": name}
+        for i, line in enumerate(lines):
+            at = line.find("panicked at ")
+            if at == -1:
+                continue
+            panic = line[at + len("panicked at "):]
 
-        elif line.startswith("----"):
-            accumulated_message = line
+            location = _PANIC_LOCATION.match(panic)
+            if location is not None:
+                text = []
+                for following in lines[i + 1:]:
+                    if not following or following == "stack backtrace:" or following.startswith("note:"):
+                        break
+                    text.append(following)
+            elif panic.startswith("'"):
+                text = [panic[1:]]
+                for following in lines[i + 1:]:
+                    if _QUOTED_PANIC_LOCATION.search(text[-1]) is not None:
+                        break
+                    text.append(following)
+                location = _QUOTED_PANIC_LOCATION.search(text[-1])
+                if location is not None:
+                    text[-1] = text[-1][:location.start()]
+            else:
+                continue
 
-    if accumulated_message != "":
-        messages.append(_parse_accumulated_message(
-            accumulated_message,
-            path_transformer
-        ))
+            if location is not None:
+                m.filename = self.path_transformer(location.group(1))
+                m.line = int(location.group(2))
+                if location.group(3) is not None:
+                    m.column = int(location.group(3))
+            m.text = " ".join([name] + text)
+            return m
 
-    return messages
+        text = [line for line in lines if line]
+        m.text = " ".join([name] + text[:1]) if text else "%s failed" % name
+        return m
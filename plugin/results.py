@@ -0,0 +1,207 @@
+#
+#   results.py
+#
+#   results.py puts together the response for vim from the messages of one
+#   or more builds, which may be reported from several threads at once.
+
+import json
+import sys
+import threading
+import time
+
+import parse
+import snapshots
+import stats
+
+# result is the final response for vim. It holds the complete quickfix
+# list, unless it's merged with the changes from a snapshots.Diff.
+def result(reason, quickfix=[]):
+    return {
+        "message": reason,
+        "quickfix": [m.render_tree() for m in quickfix],
+        "reset": True,
+    }
+
+try:
+    import orjson
+    def _dumps(data):
+        return orjson.dumps(data).decode('utf-8')
+except ImportError:
+    _dumps = json.dumps
+
+# encode returns `response` as JSON.
+def encode(response):
+    return _dumps(response)
+
+# write writes the final response to the `output` file that vim asked for,
+# or else to stdout. Vim reads the file directly, which is much faster
+# than taking a large result from system(). Like every line that emit
+# writes, it ends with a newline, so that a reader that goes by lines gets
+# it as a complete line.
+def write(response, options):
+    data = encode(response) + "\n"
+    if options.get("output"):
+        with open(options["output"], "w") as f:
+            f.write(data)
+    else:
+        sys.stdout.write(data)
+
+# In streaming mode, every batch of messages is written as its own line
+# of JSON, so vim can append it to the quickfix list right away. The
+# final line is the usual result, which also contains the message.
+def emit(response):
+    sys.stdout.write(encode(response) + "\n")
+    sys.stdout.flush()
+
+def _location(m):
+    return (m.filename, m.line, m.column)
+
+# Batches that come within this many seconds of the last one that was
+# sent are held back and sent together. Vim handles every line on its own,
+# which costs more than decoding it, and cargo reports each message as a
+# batch of its own.
+EMIT_INTERVAL = 0.05
+
+# Collector takes the messages of a command as they're parsed. Duplicates
+# are dropped (see parse.Deduplicator), and if `emit` is given, the new
+# messages are passed to it right away. `context` and `options` are
+# described in snapshots.Diff and cargo.run, and the time spent here is
+# counted in `recorder` (see stats.py).
+class Collector(object):
+    def __init__(self, context, options, emit=None, recorder=stats.NO_STATS):
+        self.deduplicator = parse.Deduplicator(options.get("merge_duplicates"))
+        # Targeted test runs are merged into whatever vim is showing, so
+        # there's no snapshot to compare with.
+        self.diff = None
+        if options.get("tests") is None:
+            self.diff = snapshots.Diff(context, options.get("snapshot"))
+        self.emit = emit
+        self.recorder = recorder
+        self.errors = []
+        self.warnings = []
+        self.lock = threading.Lock()
+        # Errors are always kept, but only this many warnings are. Once
+        # there are this many errors, a build whose log would run on and on
+        # can stop (see full).
+        self.limit = options.get("max_messages") or None
+        self.dropped = 0
+        self.stopped = False
+        self.pending = []
+        # The warnings passed on to vim, which are taken back once there's
+        # an error (see add).
+        self.sent_warnings = []
+        self.last_emit = 0
+        self.timer = None
+
+        if self.emit is not None and self.diff is not None and self.diff.reset:
+            self.emit({"quickfix": [], "reset": True})
+
+    def add(self, batch):
+        with self.lock:
+            with self.recorder.phase("dedup"):
+                batch = [m for m in batch if self.deduplicator.add(m)]
+            kept = []
+            for m in batch:
+                if m.level != 'warning':
+                    self.errors.append(m)
+                elif self.limit is None or len(self.warnings) < self.limit:
+                    self.warnings.append(m)
+                else:
+                    self.dropped += 1
+                    continue
+                kept.append(m)
+            batch = kept
+
+            if self.emit is not None:
+                with self.recorder.phase("emit"):
+                    # Like the final list (see _finish), the streamed one
+                    # only has warnings until there's an error. The ones
+                    # already sent are removed when the command finishes.
+                    if self.errors:
+                        batch = [m for m in batch if m.level != 'warning']
+                        self.pending = [r for r in self.pending if r["type"] != "W"]
+                    else:
+                        self.sent_warnings.extend(batch)
+                    if self.diff is not None:
+                        batch = self.diff.added(batch)
+                    self.pending.extend(m.render_tree() for m in batch)
+                    wait = self.last_emit + EMIT_INTERVAL - time.time()
+                    if wait <= 0:
+                        self._flush()
+                    elif self.timer is None and self.pending:
+                        self.timer = threading.Timer(wait, self._flush_later)
+                        self.timer.daemon = True
+                        self.timer.start()
+
+    # _flush sends the pending messages. The lock must be held.
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.pending:
+            self.emit({"quickfix": self.pending})
+            self.pending = []
+            self.last_emit = time.time()
+
+    def _flush_later(self):
+        with self.lock:
+            self.timer = None
+            self._flush()
+
+    # full returns whether there are as many errors as the limit, so that
+    # a build can stop early instead of going through all of a huge log.
+    def full(self):
+        with self.lock:
+            return self.limit is not None and len(self.errors) >= self.limit
+
+    # stop records that a build was stopped because the collector was full.
+    def stop(self):
+        self.stopped = True
+
+    # finish returns the final response for `tool command`. If the
+    # messages came from several builds, they're sorted by location, since
+    # the order they arrived in is arbitrary.
+    def finish(self, tool, command, merged=False):
+        if self.emit is not None:
+            with self.lock:
+                self._flush()
+        self.recorder.count("errors", len(self.errors))
+        self.recorder.count("warnings", len(self.warnings))
+        with self.recorder.phase("render"):
+            return self._finish(tool, command, merged)
+
+    def _finish(self, tool, command, merged):
+        quickfix = []
+        reason = "`%s %s`: success" % (tool, command)
+        if len(self.errors) > 0:
+            reason = "`%s %s` failed, check quickfix" % (tool, command)
+            quickfix = self.errors
+        elif len(self.warnings) > 0:
+            reason = "`%s %s` succeeded with warnings, check quickfix" % (tool, command)
+            quickfix = self.warnings
+        if self.stopped:
+            reason += " (stopped after %d errors)" % self.limit
+        elif self.dropped and not self.errors:
+            reason += " (showing the first %d warnings)" % self.limit
+
+        # Everything has been sent already in streaming mode.
+        if self.emit is not None:
+            quickfix = []
+            if self.errors and self.diff is not None:
+                self.diff.withdraw(self.sent_warnings)
+        else:
+            if merged:
+                quickfix = sorted(quickfix, key=_location)
+            if self.diff is not None:
+                quickfix = self.diff.added(quickfix)
+
+        response = result(reason, quickfix)
+        if self.diff is not None:
+            response.update(self.diff.finish())
+        else:
+            response["reset"] = False
+        if self.emit is not None:
+            response["reset"] = False
+            # Let vim sort what it has been sent.
+            response["sort"] = merged
+        return response
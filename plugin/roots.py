@@ -0,0 +1,381 @@
+#
+#   roots.py
+#
+#   roots.py finds the root directory of the project that a file belongs to,
+#   i.e. the directory with Cargo.toml or the bazel WORKSPACE. Walking up the
+#   tree costs a stat per parent directory, which is slow on network mounts,
+#   so the results are remembered (also on disk, between runs) and only
+#   checked again when one of the marker files has changed.
+
+import hashlib
+import json
+import os
+import re
+import subprocess
+import threading
+
+import store
+
+CARGO_MARKERS = ["Cargo.toml"]
+BAZEL_MARKERS = ["WORKSPACE", "WORKSPACE.bazel", "MODULE.bazel"]
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+# The number of entries a RootCache keeps. The oldest are dropped first.
+MAX_ENTRIES = 1000
+
+class RootCache(object):
+    def __init__(self, path):
+        self.path = path
+        self.entries = None
+        # server.py looks up roots from several threads at once.
+        self.lock = threading.Lock()
+
+    def _load(self):
+        if self.entries is None:
+            self.entries = store.load(self.path, {})
+
+    # get returns the cached value for `key`, as long as none of the marker
+    # files it was derived from have changed since.
+    def get(self, key):
+        with self.lock:
+            return self._get(key)
+
+    def _get(self, key):
+        self._load()
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        for path, mtime in entry["markers"].items():
+            if _mtime(path) != mtime:
+                del self.entries[key]
+                return None
+        return entry["value"]
+
+    # put caches `value` for `key`. `markers` are the files the value was
+    # derived from, which must still exist.
+    def put(self, key, value, markers):
+        with self.lock:
+            self._put(key, value, markers)
+
+    def _put(self, key, value, markers):
+        self._load()
+        self.entries[key] = {
+            "value": value,
+            "markers": dict((path, _mtime(path)) for path in markers),
+            "order": max([e.get("order", 0) for e in self.entries.values()] + [0]) + 1,
+        }
+        while len(self.entries) > MAX_ENTRIES:
+            oldest = min(self.entries, key=lambda k: self.entries[k].get("order", 0))
+            del self.entries[oldest]
+        store.save(self.path, self.entries)
+
+_cache = RootCache(store.path("roots.json"))
+
+# _find_marker walks up from `directory` until it finds a directory that
+# contains one of `markers`. It returns the path of that marker file, or
+# None if the top level directory is reached.
+def _find_marker(directory, markers):
+    while True:
+        for marker in markers:
+            path = os.path.join(directory, marker)
+            if os.path.isfile(path):
+                return path
+        parent_directory = os.path.dirname(directory)
+        # Make sure we haven't reached the top level directory.
+        if parent_directory == directory:
+            return None
+        directory = parent_directory
+
+def _is_cargo_workspace(manifest):
+    try:
+        with open(manifest) as f:
+            return re.search(r"^\s*\[workspace\]", f.read(), re.M) is not None
+    except (IOError, OSError):
+        return False
+
+# find_cargo_dirs returns the directory of the package that `file_path`
+# belongs to, and the root of its workspace, which is where cargo reports
+# paths relative to. For packages outside of a workspace, both are the same
+# directory. Returns None if the file isn't part of a cargo project.
+def find_cargo_dirs(file_path):
+    start = os.path.dirname(file_path)
+    key = "cargo:" + start
+    dirs = _cache.get(key)
+    if dirs is not None:
+        return tuple(dirs)
+
+    manifest = _find_marker(start, CARGO_MARKERS)
+    if manifest is None:
+        return None
+    package_dir = os.path.dirname(manifest)
+
+    # The workspace is declared in the first Cargo.toml above (or at) the
+    # package that has a [workspace] section.
+    markers = []
+    workspace_dir = package_dir
+    candidate = manifest
+    while candidate is not None:
+        markers.append(candidate)
+        if _is_cargo_workspace(candidate):
+            workspace_dir = os.path.dirname(candidate)
+            break
+        parent_directory = os.path.dirname(os.path.dirname(candidate))
+        if parent_directory == os.path.dirname(candidate):
+            break
+        candidate = _find_marker(parent_directory, CARGO_MARKERS)
+
+    _cache.put(key, [package_dir, workspace_dir], markers)
+    return package_dir, workspace_dir
+
+# The cache key of cargo_metadata. The version changes whenever the fields
+# of the cached packages do, so that entries of an older version aren't
+# used.
+METADATA_KEY = "metadata-v3:"
+
+# The number of workspaces whose packages are remembered. Each has a file
+# of its own, since the packages of a large workspace take up much more
+# room than all the roots, and are needed much less often.
+MAX_WORKSPACES = 50
+
+_metadata_caches = {}
+_metadata_lock = threading.Lock()
+
+def _metadata_dir():
+    return os.path.join(os.path.dirname(_cache.path), "metadata")
+
+def _metadata_cache(workspace_dir):
+    name = hashlib.sha1(workspace_dir.encode('utf-8')).hexdigest() + ".json"
+    path = os.path.join(_metadata_dir(), name)
+    with _metadata_lock:
+        if path not in _metadata_caches:
+            _metadata_caches[path] = RootCache(path)
+        return _metadata_caches[path]
+
+# _prune_metadata removes the files of the workspaces whose packages were
+# looked up longest ago, beyond MAX_WORKSPACES.
+def _prune_metadata():
+    directory = _metadata_dir()
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    paths = [os.path.join(directory, name) for name in names if name.endswith(".json")]
+    if len(paths) <= MAX_WORKSPACES:
+        return
+    paths.sort(key=lambda path: _mtime(path) or 0)
+    for path in paths[:len(paths) - MAX_WORKSPACES]:
+        store.remove(path)
+
+# cargo_metadata returns the packages of the workspace at `workspace_dir`
+# as reported by `cargo metadata`: their name, directory, edition,
+# targets, and the directories of their path dependencies. It takes cargo a moment to work that out, so the result is
+# cached until one of the manifests or the lock file changes, or `refresh`
+# is set.
+def cargo_metadata(workspace_dir, refresh=False):
+    key = METADATA_KEY + workspace_dir
+    cache = _metadata_cache(workspace_dir)
+    packages = None if refresh else cache.get(key)
+    if packages is not None:
+        return packages
+    _rechecked.pop(workspace_dir, None)
+
+    markers = [
+        os.path.join(workspace_dir, "Cargo.toml"),
+        os.path.join(workspace_dir, "Cargo.lock"),
+    ]
+    try:
+        output = subprocess.check_output(
+            ["cargo", "metadata", "--format-version", "1", "--no-deps"],
+            cwd=workspace_dir,
+            stderr=open(os.devnull, 'w')
+        )
+        metadata = json.loads(output.decode('utf-8'))
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        # A failure isn't cached: it could be fixed in the manifest of any
+        # member, and those aren't known until cargo succeeds.
+        return []
+
+    packages = []
+    for package in metadata.get("packages", []):
+        markers.append(package["manifest_path"])
+        packages.append({
+            "name": package["name"],
+            "dir": os.path.dirname(package["manifest_path"]),
+            "edition": package.get("edition", "2015"),
+            "path_dependencies": sorted(set(
+                d["path"] for d in package.get("dependencies", []) if d.get("path")
+            )),
+            "targets": [
+                {"kind": t["kind"], "name": t["name"], "src_path": t["src_path"]}
+                for t in package.get("targets", [])
+            ],
+        })
+    cache.put(key, packages, markers)
+    _prune_metadata()
+    return packages
+
+# _cargo_owner returns the package in the workspace at `workspace_dir`
+# that `file_path` belongs to (see cargo_metadata), or None.
+def _cargo_owner(file_path, workspace_dir, refresh=False):
+    owner = None
+    for package in cargo_metadata(workspace_dir, refresh):
+        if file_path.startswith(package["dir"] + os.sep):
+            if owner is None or len(package["dir"]) > len(owner["dir"]):
+                owner = package
+    return owner
+
+# find_cargo_package returns the name of the package in the workspace at
+# `workspace_dir` that `file_path` belongs to, and the arguments that pick
+# the target the file is part of, e.g. ["--bin", "tool"]. The target
+# arguments are None when it can't be told from the paths alone, and the
+# whole result is None if cargo doesn't know the package.
+#
+# cargo also finds targets by their paths, e.g. src/bin/tool.rs, so adding
+# one doesn't change any manifest. If the file looks like a target that
+# the cached metadata doesn't have, cargo is asked again, once for each
+# file until the metadata changes.
+def find_cargo_package(file_path, workspace_dir):
+    owner = _cargo_owner(file_path, workspace_dir)
+    if owner is not None and _unknown_target(file_path, owner):
+        checked = _rechecked.get(workspace_dir, set())
+        if file_path not in checked:
+            owner = _cargo_owner(file_path, workspace_dir, refresh=True)
+            _rechecked.setdefault(workspace_dir, set()).add(file_path)
+    if owner is None:
+        return None
+    return owner["name"], cargo_target(file_path, owner["targets"])
+
+# The files that cargo_metadata was run again for by find_cargo_package,
+# for each workspace.
+_rechecked = {}
+
+# The directories where cargo finds targets that the manifest doesn't
+# list, besides src/lib.rs and src/main.rs.
+_TARGET_DIRS = [os.path.join("src", "bin"), "examples", "tests", "benches"]
+
+# _unknown_target returns whether `file_path` could be a target of
+# `package` that isn't among its targets: it's outside the directories of
+# all of them, or where cargo would find a target, e.g. src/bin/tool.rs or
+# src/bin/tool/main.rs.
+def _unknown_target(file_path, package):
+    targets = package["targets"]
+    if any(t["src_path"] == file_path for t in targets):
+        return False
+    if not any(file_path.startswith(os.path.dirname(t["src_path"]) + os.sep) for t in targets):
+        return True
+    relative = os.path.relpath(file_path, package["dir"])
+    if relative in (os.path.join("src", "lib.rs"), os.path.join("src", "main.rs")):
+        return True
+    directory, name = os.path.split(relative)
+    if name == "main.rs":
+        directory = os.path.dirname(directory)
+    return directory in _TARGET_DIRS
+
+# cargo_edition returns the rust edition of the package that `file_path`
+# belongs to, or None if cargo doesn't know the package.
+def cargo_edition(file_path, workspace_dir):
+    owner = _cargo_owner(file_path, workspace_dir)
+    return owner and owner["edition"]
+
+# The kinds of library targets, which are all selected with --lib.
+_LIBRARY_KINDS = ["lib", "rlib", "dylib", "cdylib", "staticlib", "proc-macro"]
+
+# cargo_target returns the arguments that select the target among
+# `targets` that `file_path` is part of, or None if it isn't clear which.
+# That's the target whose root is the file, or else the target whose root
+# is in the closest directory above the file, if there's only one. A
+# module next to both lib.rs and main.rs could belong to either.
+def cargo_target(file_path, targets):
+    candidates = []
+    for target in targets:
+        if "custom-build" in target["kind"]:
+            continue
+        if target["src_path"] == file_path:
+            return _target_args(target)
+        directory = os.path.dirname(target["src_path"])
+        if file_path.startswith(directory + os.sep):
+            candidates.append((len(directory), target))
+    if not candidates:
+        return None
+    closest = max(length for length, _ in candidates)
+    candidates = [target for length, target in candidates if length == closest]
+    if len(candidates) != 1:
+        return None
+    return _target_args(candidates[0])
+
+def _target_args(target):
+    kind = target["kind"][0]
+    if kind in _LIBRARY_KINDS:
+        return ["--lib"]
+    if kind in ("bin", "test", "bench", "example"):
+        return ["--%s" % kind, target["name"]]
+    return None
+
+TOOLCHAIN_FILES = ["rust-toolchain.toml", "rust-toolchain"]
+
+# find_toolchain_file returns the rust-toolchain file that makes rustup
+# pick the toolchain in `directory`, i.e. the closest one at or above it,
+# or None.
+def find_toolchain_file(directory):
+    return _find_marker(directory, TOOLCHAIN_FILES)
+
+RUSTFMT_CONFIGS = ["rustfmt.toml", ".rustfmt.toml"]
+
+# find_rustfmt_config returns the rustfmt.toml that applies to the files
+# of the package at `package_dir`, i.e. the closest one at or above it, or
+# None. rustfmt would search for it again on every run. Not finding one is
+# remembered too, until the package's Cargo.toml changes.
+def find_rustfmt_config(package_dir):
+    key = "rustfmt:" + package_dir
+    config = _cache.get(key)
+    if config is not None:
+        return config or None
+
+    config = _find_marker(package_dir, RUSTFMT_CONFIGS)
+    markers = [config] if config else [os.path.join(package_dir, "Cargo.toml")]
+    _cache.put(key, config or "", markers)
+    return config
+
+# find_bazel_dir returns the root of the bazel workspace containing
+# `directory`, or None if there isn't one.
+def find_bazel_dir(directory):
+    key = "bazel:" + directory
+    bazel_dir = _cache.get(key)
+    if bazel_dir is not None:
+        return bazel_dir
+
+    marker = _find_marker(directory, BAZEL_MARKERS)
+    if marker is None:
+        return None
+
+    bazel_dir = os.path.dirname(marker)
+    _cache.put(key, bazel_dir, [marker])
+    return bazel_dir
+
+# modified_files returns the absolute paths of the files in the git
+# repository containing `cwd` that differ from HEAD, including new files
+# that aren't ignored.
+def modified_files(cwd):
+    def git(directory, *args):
+        try:
+            output = subprocess.check_output(
+                ("git",) + args,
+                cwd=directory,
+                stderr=open(os.devnull, 'w')
+            )
+        except (OSError, subprocess.CalledProcessError):
+            return []
+        return [line for line in output.decode('utf-8', 'replace').split("\n") if line]
+
+    toplevel = git(cwd, "rev-parse", "--show-toplevel")
+    if not toplevel:
+        return []
+    toplevel = toplevel[0]
+    changed = git(toplevel, "diff", "--name-only", "HEAD") + \
+        git(toplevel, "ls-files", "--others", "--exclude-standard")
+    return sorted(set(os.path.join(toplevel, path) for path in changed))
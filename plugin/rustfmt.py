@@ -0,0 +1,182 @@
+#
+#   rustfmt.py
+#
+#   rustfmt.py formats a rust buffer with rustfmt, and returns the result as
+#   the ranges of lines that differ from the buffer, so that vim can change
+#   just those lines instead of replacing the whole buffer. It runs in
+#   server.py like cargo.py, or on its own with the options (including the
+#   buffer) on stdin:
+#
+#       python rustfmt.py format FILE CWD < options.json
+
+import difflib
+import json
+import os
+import subprocess
+import sys
+
+import jobs
+import results
+import roots
+import stats
+
+# run formats the buffer of `file_path`, and returns the result for vim,
+# with the `edits` to make to the buffer (see edits). `command` is always
+# "format". `options` are:
+#
+#   text:      the lines of the buffer.
+#   previous:  the lines of the file as it was last written. If it's given,
+#              only the lines that changed since then are formatted.
+#   stats:     see cargo.run.
+#   stats_log: see cargo.run.
+def run(command, file_path, cwd, emit=None, job=None, options=None):
+    options = options or {}
+    recorder = stats.start(options)
+    path = os.path.join(cwd, file_path)
+    text = options.get("text") or []
+
+    ranges = None
+    if options.get("previous") is not None:
+        ranges = changed_lines(options["previous"], text)
+        if not ranges:
+            return _finish(recorder, [], "`rustfmt`: nothing to format", command, cwd, options)
+
+    with recorder.phase("roots"):
+        argv, directory = rustfmt_args(path)
+    # rustfmt can format just some of the lines on nightly. Elsewhere the
+    # whole file is formatted, and only the changes that touch those lines
+    # are kept.
+    keep = ranges
+    if ranges is not None and file_lines(directory):
+        argv += ["--unstable-features", "--file-lines", json.dumps([
+            {"file": "stdin", "range": r} for r in ranges
+        ])]
+        keep = None
+
+    if job is None:
+        job = jobs.Job()
+    with recorder.phase("command"):
+        output = job.communicate(argv, directory, "".join(line + "\n" for line in text))
+    if output is None:
+        return results.result("`rustfmt` was cancelled")
+    returncode, stdout, stderr = output
+    if returncode != 0:
+        response = results.result("`rustfmt` failed: %s" % _error(stderr, file_path))
+        response["failed"] = True
+        return stats.finish(recorder, response, "rustfmt", command, cwd, options)
+
+    formatted = stdout.split("\n")
+    if formatted[-1] == "":
+        formatted.pop()
+    with recorder.phase("parse"):
+        changes = edits(text, formatted, keep)
+    if not changes:
+        return _finish(recorder, [], "`rustfmt`: already formatted", command, cwd, options)
+    return _finish(recorder, changes, "`rustfmt`: formatted", command, cwd, options)
+
+def _finish(recorder, changes, message, command, cwd, options):
+    response = results.result(message)
+    response["edits"] = changes
+    return stats.finish(recorder, response, "rustfmt", command, cwd, options)
+
+# _error returns the first line of rustfmt's error output, with where the
+# error is, e.g. "this file contains an unclosed delimiter (src/lib.rs:1:16)".
+def _error(stderr, file_path):
+    lines = [line.strip() for line in stderr.split("\n") if line.strip()]
+    if not lines:
+        return "no output"
+    message = lines[0]
+    if message.startswith("error: "):
+        message = message[len("error: "):]
+    for line in lines[1:]:
+        if line.startswith("--> <stdin>:"):
+            message += " (%s:%s)" % (file_path, line[len("--> <stdin>:"):])
+            break
+    return message
+
+# rustfmt_args returns the rustfmt command line for the file at `path`, and
+# the directory to run it in. Like `cargo fmt`, it passes the edition of
+# the package, since rustfmt assumes 2015 when it formats its input. The
+# edition and the config file are looked up once per package (see
+# roots.py).
+def rustfmt_args(path):
+    argv = ["rustfmt", "--emit", "stdout", "--quiet"]
+    directory = os.path.dirname(path)
+    dirs = roots.find_cargo_dirs(path)
+    if dirs is None:
+        return argv, directory
+
+    package_dir, workspace_dir = dirs
+    edition = roots.cargo_edition(path, workspace_dir)
+    if edition:
+        argv += ["--edition", edition]
+    config = roots.find_rustfmt_config(package_dir)
+    if config:
+        argv += ["--config-path", config]
+    return argv, package_dir
+
+# changed_lines returns the lines of `text` that differ from `previous`, as
+# [first, last] ranges counting from 1. Where lines were only deleted, the
+# line after them counts as changed.
+def changed_lines(previous, text):
+    ranges = []
+    matcher = difflib.SequenceMatcher(None, previous, text, autojunk=False)
+    for tag, _, _, j1, j2 in matcher.get_opcodes():
+        if tag == "equal" or not text:
+            continue
+        first = min(j1 + 1, len(text))
+        last = max(j2, first)
+        if ranges and first <= ranges[-1][1] + 1:
+            ranges[-1][1] = max(ranges[-1][1], last)
+        else:
+            ranges.append([first, last])
+    return ranges
+
+# edits returns the changes that turn the lines `text` into `formatted`, as
+# [start, end, lines]: the lines from `start` up to `end` (counting from 0)
+# are replaced with `lines`. With `keep`, only the changes that touch one
+# of those ranges (see changed_lines) are returned.
+def edits(text, formatted, keep=None):
+    changes = []
+    matcher = difflib.SequenceMatcher(None, text, formatted, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        if keep is not None and not _touches(i1, i2, keep):
+            continue
+        changes.append([i1, i2, formatted[j1:j2]])
+    return changes
+
+# _touches returns whether the lines from `start` up to `end` touch one of
+# `ranges`. Lines inserted before a line touch that line.
+def _touches(start, end, ranges):
+    first = start + 1
+    last = max(end, first)
+    return any(r[0] <= last and first <= r[1] for r in ranges)
+
+# file_lines returns whether the rustfmt used in `directory` can format
+# only some of the lines. --file-lines is unstable, so it needs a nightly
+# rustfmt. The answer is remembered, like cargo.libtest_json.
+_file_lines = {}
+
+def file_lines(directory):
+    if directory not in _file_lines:
+        try:
+            version = subprocess.check_output(["rustfmt", "--version"], cwd=directory)
+        except (OSError, subprocess.CalledProcessError):
+            version = b""
+        _file_lines[directory] = b"-nightly" in version or b"-dev" in version
+    return _file_lines[directory]
+
+def main(argv):
+    args, options = jobs.parse_args(argv)
+    if len(args) < 3:
+        return results.result("Nothing to format")
+    try:
+        options.update(json.load(sys.stdin))
+    except ValueError:
+        return results.result("Nothing to format")
+    return run(args[0], args[1], args[2], options=options)
+
+if __name__ == '__main__':
+    results.write(main(sys.argv), jobs.parse_args(sys.argv)[1])
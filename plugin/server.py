@@ -0,0 +1,229 @@
+#
+#   server.py
+#
+#   server.py keeps the python side of the plugin running between commands,
+#   so that each command doesn't pay for starting python, importing the
+#   parser and searching for the project root again. Vim starts it once and
+#   talks to it over stdin/stdout, one JSON object per line.
+#
+#   Requests:
+#
+#       {"id": 1, "method": "run", "tool": "cargo", "command": "build",
+#        "file": "/path/to/src/lib.rs", "cwd": "/path/to", "options": {},
+#        "priority": "interactive"}
+#       {"id": 1, "method": "cancel"}
+#
+#   Responses to a `run` request carry its id. There are zero or more
+#   batches of messages, followed by the final result:
+#
+#       {"id": 1, "quickfix": [...]}
+#       {"id": 1, "message": "`cargo build`: success", "quickfix": [...],
+#        "snapshot": "...", "removed": [...], "reset": false}
+#
+#   See snapshots.py for the last three fields. The tool is "cargo",
+#   "bazel" or "rustfmt", whose results carry edits to the buffer instead
+#   of messages (see rustfmt.py).
+#
+#   Requests for the same project root run one at a time, since cargo and
+#   bazel lock the build directory: a build started next to another one
+#   just waits for the lock, and holds up everything after it. The waiting
+#   requests start in order of priority, "background" ones (e.g. checks on
+#   save) after all others. A request for the same thing as a waiting one
+#   replaces it, and one that makes the running one pointless (the same
+#   request, or anything over a background one) cancels it. Vim only shows
+#   the results of the newest request it sent, by its id.
+
+import json
+import os
+import signal
+import sys
+import threading
+
+import bazel
+import cargo
+import jobs
+import results
+import roots
+import rustfmt
+
+TOOLS = {
+    "cargo": cargo.run,
+    "bazel": bazel.run,
+    "rustfmt": rustfmt.run,
+}
+
+# _root returns the project root that `request` builds in.
+def _root(request):
+    path = os.path.join(request.get("cwd", ""), request.get("file", ""))
+    root = None
+    if request.get("tool") == "cargo":
+        dirs = roots.find_cargo_dirs(path)
+        root = dirs and dirs[1]
+    elif request.get("tool") == "bazel":
+        root = roots.find_bazel_dir(os.path.dirname(path))
+    return (request.get("tool"), root or request.get("cwd"))
+
+def _background(request):
+    return request.get("priority") == "background"
+
+# _same returns whether two requests would build the same thing. The
+# snapshot only says what vim is showing.
+def _same(a, b):
+    def key(request):
+        options = dict(request.get("options") or {})
+        options.pop("snapshot", None)
+        return (request.get("tool"), request.get("command"), request.get("file"),
+                request.get("cwd"), sorted(options.items()))
+    return key(a) == key(b)
+
+class _Queue(object):
+    def __init__(self):
+        self.running = None
+        self.waiting = []
+
+class Server(object):
+    def __init__(self, output):
+        self.output = output
+        self.lock = threading.Lock()
+        self.jobs = {}
+        # The requests of each project root, see above.
+        self.queues = {}
+        # Reentrant, since stop() may run in a signal handler while the
+        # main thread holds it.
+        self.queue_lock = threading.RLock()
+
+    def send(self, response):
+        line = results.encode(response)
+        with self.lock:
+            self.output.write(line + "\n")
+            self.output.flush()
+
+    def cancelled(self, request):
+        response = results.result("`%s %s` was cancelled" % (request.get("tool"), request.get("command")))
+        response["id"] = request["id"]
+        self.send(response)
+
+    def handle(self, request):
+        if request.get("method") == "cancel":
+            with self.queue_lock:
+                waiting = self._unqueue(lambda r: r["id"] == request["id"])
+                job = self.jobs.get(request["id"])
+            if waiting:
+                self.cancelled(waiting[0])
+            elif job is not None:
+                job.cancel()
+            return
+
+        root = _root(request)
+        with self.queue_lock:
+            self.jobs[request["id"]] = jobs.Job()
+            queue = self.queues.setdefault(root, _Queue())
+            replaced = self._unqueue(lambda r: _same(r, request))
+            position = len(queue.waiting)
+            if not _background(request):
+                # Ahead of the background requests.
+                position = len([r for r in queue.waiting if not _background(r)])
+            queue.waiting.insert(position, request)
+
+            running = queue.running
+            if running is not None and (_same(running, request) or
+                    (_background(running) and not _background(request))):
+                job = self.jobs.get(running["id"])
+                if job is not None:
+                    job.cancel()
+            self._next(root, queue)
+
+        for r in replaced:
+            self.cancelled(r)
+
+    # _unqueue takes the waiting requests that match `predicate` out of
+    # their queues, and returns them. The queue lock must be held.
+    def _unqueue(self, predicate):
+        removed = []
+        for queue in self.queues.values():
+            removed += [r for r in queue.waiting if predicate(r)]
+            queue.waiting = [r for r in queue.waiting if not predicate(r)]
+        for r in removed:
+            self.jobs.pop(r["id"], None)
+        return removed
+
+    # _next starts the first waiting request of `queue` if nothing is
+    # running for its root. The queue lock must be held.
+    def _next(self, root, queue):
+        if queue.running is not None or not queue.waiting:
+            return
+        queue.running = queue.waiting.pop(0)
+        thread = threading.Thread(target=self.run, args=(root, queue.running))
+        thread.daemon = True
+        thread.start()
+
+    def run(self, root, request):
+        request_id = request["id"]
+        job = self.jobs[request_id]
+        def emit(response):
+            response["id"] = request_id
+            self.send(response)
+
+        response = None
+        try:
+            run = TOOLS.get(request.get("tool"))
+            if run is None:
+                response = results.result("No such tool: `%s`" % request.get("tool"))
+            else:
+                response = run(
+                    request["command"],
+                    request["file"],
+                    request["cwd"],
+                    emit,
+                    job,
+                    request.get("options")
+                )
+        # Anything going wrong in a single command shouldn't take down the
+        # server, so report it to vim like any other result.
+        except Exception as e:
+            response = results.result("cargo-vim error: %s" % e)
+        finally:
+            # The final response goes out before the next request of the
+            # root starts, so that the responses come in order.
+            try:
+                if response is not None:
+                    response["id"] = request_id
+                    self.send(response)
+            finally:
+                with self.queue_lock:
+                    self.jobs.pop(request_id, None)
+                    queue = self.queues[root]
+                    queue.running = None
+                    self._next(root, queue)
+
+    def serve(self, requests):
+        for line in iter(requests.readline, ''):
+            try:
+                request = json.loads(line)
+            except ValueError:
+                continue
+            self.handle(request)
+
+        # Vim has gone away, so stop any builds it was waiting for.
+        self.stop()
+
+    # stop cancels every request, waiting or running. The jobs run in
+    # their own process groups (see jobs.py), so they would keep building
+    # after the server has gone.
+    def stop(self):
+        with self.queue_lock:
+            self._unqueue(lambda r: True)
+        for job in list(self.jobs.values()):
+            job.cancel()
+
+def main():
+    server = Server(sys.stdout)
+    # Vim and neovim stop the server with SIGTERM when they exit.
+    def stop(signum, frame):
+        server.stop()
+        sys.exit(1)
+    signal.signal(signal.SIGTERM, stop)
+    server.serve(sys.stdin)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#
+#   snapshots.py
+#
+#   snapshots.py remembers which messages vim is showing after the last run
+#   of each command, so that the next run can tell vim what changed instead
+#   of sending the whole quickfix list again. Vim keeps the id of the
+#   snapshot it's showing and passes it back with the next command; if that
+#   isn't the latest snapshot for the command (e.g. vim showed something
+#   else in the meantime), the whole list is sent again.
+
+import random
+import threading
+
+import store
+
+# The number of commands (tool, project and command) to remember.
+MAX_SNAPSHOTS = 20
+
+class Snapshots(object):
+    def __init__(self, path):
+        self.path = path
+        self.snapshots = None
+        self.lock = threading.Lock()
+
+    def _load(self):
+        if self.snapshots is None:
+            self.snapshots = store.load(self.path, {})
+
+    # previous returns the keys of the messages in `snapshot`, if it's the
+    # latest snapshot for `context`, and None otherwise.
+    def previous(self, context, snapshot):
+        with self.lock:
+            self._load()
+            latest = self.snapshots.get(context)
+            if snapshot is None or latest is None or latest["id"] != snapshot:
+                return None
+            return set(latest["keys"])
+
+    # save stores the keys of the messages that vim is now showing for
+    # `context`, and returns the id of the new snapshot.
+    def save(self, context, keys):
+        with self.lock:
+            self._load()
+            snapshot = "%016x" % random.getrandbits(64)
+            self.snapshots[context] = {
+                "id": snapshot,
+                "keys": list(keys),
+                "order": max([s["order"] for s in self.snapshots.values()] + [0]) + 1,
+            }
+            if len(self.snapshots) > MAX_SNAPSHOTS:
+                oldest = min(self.snapshots, key=lambda c: self.snapshots[c]["order"])
+                del self.snapshots[oldest]
+            store.save(self.path, self.snapshots)
+            return snapshot
+
+_snapshots = Snapshots(store.path("snapshots.json"))
+
+# Diff works out the changes to send to vim for one run of a command.
+# Messages are identified by Message.digest().
+class Diff(object):
+    def __init__(self, context, snapshot):
+        self.context = context
+        self.previous = _snapshots.previous(context, snapshot)
+        # If vim's list can't be patched, it needs to be cleared and
+        # everything sent again.
+        self.reset = self.previous is None
+        if self.reset:
+            self.previous = set()
+        self.shown = set()
+
+    # added records that `messages` are shown, and returns the ones that
+    # vim doesn't have yet.
+    def added(self, messages):
+        added = []
+        for m in messages:
+            key = m.digest()
+            self.shown.add(key)
+            if key not in self.previous:
+                added.append(m)
+        return added
+
+    # withdraw records that `messages`, which were shown, no longer are.
+    # Vim may have been sent them during this run, so they're removed
+    # whether or not they were in the snapshot.
+    def withdraw(self, messages):
+        for m in messages:
+            key = m.digest()
+            self.shown.discard(key)
+            self.previous.add(key)
+
+    # finish saves the new snapshot, and returns the fields that tell vim
+    # what to remove.
+    def finish(self):
+        return {
+            "snapshot": _snapshots.save(self.context, self.shown),
+            "removed": list(self.previous - self.shown),
+            "reset": self.reset,
+        }
@@ -0,0 +1,241 @@
+#
+#   stats.py
+#
+#   stats.py measures where the time of a command goes, so that a slow build
+#   can be pinned on finding the roots, waiting for cargo or bazel, decoding
+#   their output, resolving paths, or putting the results together for vim.
+#   With the `stats` option, cargo.py and bazel.py return the numbers with
+#   the result, and with `stats_log` they're also appended to a JSON lines
+#   file. Running this file prints the last runs from such a file:
+#
+#       python stats.py [COUNT] [LOG]
+#
+#   Without LOG, the runs are read from stdin, one per line.
+
+import collections
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+# The CPU time of the calling thread, where python can tell. Otherwise (on
+# python 2) it's the time of the whole process, which includes the other
+# threads.
+_cpu = getattr(time, "thread_time", None) or getattr(time, "clock", time.time)
+
+# _children_cpu is the CPU time of the processes started so far that have
+# finished, e.g. cargo and rustc.
+def _children_cpu():
+    t = os.times()
+    return t[2] + t[3]
+
+class _Phase(object):
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        stack = self.stats._stack()
+        # The time spent in nested phases is taken off this one, so that
+        # the phases add up to the time of the command.
+        stack.append([time.time(), _cpu(), 0.0, 0.0])
+
+    def __exit__(self, *exc_info):
+        stack = self.stats._stack()
+        start_wall, start_cpu, nested_wall, nested_cpu = stack.pop()
+        wall = time.time() - start_wall
+        cpu = _cpu() - start_cpu
+        if stack:
+            stack[-1][2] += wall
+            stack[-1][3] += cpu
+        self.stats._add(self.name, wall - nested_wall, cpu - nested_cpu)
+
+class _NoPhase(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+# Stats collects the timings and counts of one command, which may be
+# reported from several threads at once. The timings of a phase are added
+# up over all the threads.
+class Stats(object):
+    def __init__(self):
+        self.phases = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start_wall = time.time()
+        self.start_children = _children_cpu()
+
+    def _stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def _add(self, name, wall, cpu):
+        with self.lock:
+            phase = self.phases.setdefault(name, {"wall": 0.0, "cpu": 0.0, "calls": 0})
+            phase["wall"] += wall
+            phase["cpu"] += cpu
+            phase["calls"] += 1
+
+    # phase returns a context manager that adds the time spent in it to the
+    # phase `name`.
+    def phase(self, name):
+        return _Phase(self, name)
+
+    # timed returns `function`, counting the time spent in it as `name`.
+    def timed(self, name, function):
+        def timed_function(*args):
+            with _Phase(self, name):
+                return function(*args)
+        return timed_function
+
+    # iterate yields from `iterable`, counting the time spent getting each
+    # item as `name`. Closing it closes `iterable`.
+    def iterate(self, name, iterable):
+        iterator = iter(iterable)
+        try:
+            while True:
+                with _Phase(self, name):
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+                yield item
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    # lines is iterate for the output of a command, which also counts the
+    # lines and bytes that are read.
+    def lines(self, lines, name="command"):
+        count = 0
+        size = 0
+        try:
+            for line in self.iterate(name, lines):
+                count += 1
+                size += len(line)
+                yield line
+        finally:
+            self.count("lines", count)
+            self.count("bytes", size)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def finish(self):
+        with self.lock:
+            return {
+                "wall": time.time() - self.start_wall,
+                "children_cpu": _children_cpu() - self.start_children,
+                "phases": dict((name, dict(phase)) for name, phase in self.phases.items()),
+                "counts": dict(self.counts),
+            }
+
+# NoStats is used when the stats are off, and does nothing.
+class NoStats(object):
+    def phase(self, name):
+        return _NoPhase()
+
+    def timed(self, name, function):
+        return function
+
+    def iterate(self, name, iterable):
+        return iterable
+
+    def lines(self, lines, name="command"):
+        return lines
+
+    def count(self, name, n=1):
+        pass
+
+NO_STATS = NoStats()
+
+# start returns the Stats for a command with `options` (see cargo.run).
+def start(options):
+    if options.get("stats") or options.get("stats_log"):
+        return Stats()
+    return NO_STATS
+
+# finish adds the stats of `tool command` to `response`, and appends them to
+# the `stats_log` if there is one. The time it takes vim to decode the
+# response isn't included.
+def finish(recorder, response, tool, command, cwd, options):
+    if not isinstance(recorder, Stats):
+        return response
+    run = recorder.finish()
+    run.update({
+        "time": time.time(),
+        "host": socket.gethostname(),
+        "tool": tool,
+        "command": command,
+        "cwd": cwd,
+    })
+    if options.get("stats"):
+        response["stats"] = run
+    if options.get("stats_log"):
+        append(options["stats_log"], run)
+    return response
+
+def append(log_path, run):
+    try:
+        with open(os.path.expanduser(log_path), "a") as f:
+            f.write(json.dumps(run) + "\n")
+    except (IOError, OSError):
+        pass
+
+# The phases in the order they happen in, for describe.
+PHASES = ["roots", "cache", "command", "decode", "paths", "parse", "dedup", "emit", "render"]
+
+# describe returns one line describing `run`, e.g.
+#
+#   2024-05-01 12:00:03  host  cargo build  2.31s  roots 1ms  command 2104ms  ...
+def describe(run):
+    phases = run.get("phases", {})
+    names = [p for p in PHASES if p in phases] + sorted(p for p in phases if p not in PHASES)
+    counts = run.get("counts", {})
+    return "  ".join(
+        [
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(run.get("time", 0))),
+            run.get("host", "?"),
+            "%s %s" % (run.get("tool", "?"), run.get("command", "?")),
+            "%.2fs" % run.get("wall", 0),
+        ] +
+        ["%s %.0fms" % (name, phases[name]["wall"] * 1000) for name in names] +
+        ["%s %d" % (name, counts[name]) for name in sorted(counts)]
+    )
+
+# last returns the last `count` runs in `lines`, skipping any that can't be
+# read.
+def last(lines, count):
+    runs = collections.deque(maxlen=count)
+    for line in lines:
+        try:
+            runs.append(json.loads(line))
+        except ValueError:
+            continue
+    return list(runs)
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 10
+    if len(argv) > 2:
+        try:
+            with open(os.path.expanduser(argv[2])) as f:
+                runs = last(f, count)
+        except (IOError, OSError):
+            runs = []
+    else:
+        runs = last(sys.stdin, count)
+    for run in runs:
+        print(describe(run))
+
+if __name__ == '__main__':
+    main(sys.argv)
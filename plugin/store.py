@@ -0,0 +1,51 @@
+#
+#   store.py
+#
+#   store.py keeps the plugin's state on disk between runs, as JSON files in
+#   the cache directory. Everything stored here is only an optimization, so
+#   failing to read or write a file is never an error.
+
+import json
+import os
+
+# cache_dir returns the directory where the plugin keeps its caches.
+def cache_dir():
+    directory = os.environ.get("CARGO_VIM_CACHE_DIR")
+    if not directory:
+        directory = os.path.join(
+            os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+            "cargo-vim"
+        )
+    return directory
+
+def path(name):
+    return os.path.join(cache_dir(), name)
+
+# load returns the data stored in `file_path`, or `default` if there isn't
+# any (or it can't be read).
+def load(file_path, default):
+    try:
+        with open(file_path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+def save(file_path, data):
+    try:
+        directory = os.path.dirname(file_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Write to a temporary file first, so that concurrent runs never
+        # read a half written file.
+        temporary = "%s.%d" % (file_path, os.getpid())
+        with open(temporary, "w") as f:
+            json.dump(data, f)
+        os.rename(temporary, file_path)
+    except (IOError, OSError):
+        pass
+
+def remove(file_path):
+    try:
+        os.remove(file_path)
+    except OSError:
+        pass
@@ -8,24 +8,42 @@
 #   correctly decode test output.
 #
 
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
+import builds
+import cargo
+import jobs
 import parse
+import results
+import roots
+import rustfmt
+import server
+import snapshots
+import stats
+import store
 
 def path_transformer(path):
     return path
 
-def message_object(filename, line, text, warning=False, column=0):
+def message_object(filename, line, text, warning=False, column=0, test=None):
     m = parse.Message()
     m.text = text
     m.filename = filename
     m.line = line
     m.column = column
     m.level = 'warning' if warning else 'error'
+    if test is not None:
+        m.test = {"name": test}
     return m
 
-def message(filename, line, text, warning=False, column=0):
-    return message_object(filename, line, text, warning).render()
+def message(filename, line, text, warning=False, column=0, test=None):
+    return message_object(filename, line, text, warning, test=test).render()
 
 class TestParseData(unittest.TestCase):
     def test_parse_output(self):
@@ -52,8 +70,8 @@ test result: FAILED. 0 passed; 1 failed; 0 ignored; 0 measured
         self.assertItemsEqual(
             [ m.render() for m in messages ],
             [
-                message("src/bloop.rs", 7, "bloop::test_something assertion failed: `(left == right)` (left: `true`, right: `false`)"),
-                message("src/bloop.rs", 12, "bloop::test_something_else assertion failed: `(left == right)` (left: `\"asdf\"`, right: `\"asdfasdf\"`)")
+                message("src/bloop.rs", 7, "bloop::test_something assertion failed: `(left == right)` (left: `true`, right: `false`)", test="bloop::test_something"),
+                message("src/bloop.rs", 12, "bloop::test_something_else assertion failed: `(left == right)` (left: `\"asdf\"`, right: `\"asdfasdf\"`)", test="bloop::test_something_else")
             ]
         )
 
@@ -75,29 +93,107 @@ test result: FAILED. 0 passed; 1 failed; 0 ignored; 0 measured
             [ m.render() for m in warnings ],
             [
                 message("src/lib.rs", 9, "function is never used: `unused`", True),
+                message("src/lib.rs", 9, "note: #[warn(dead_code)] on by default", True),
                 message("src/lib.rs", 9, "unused variable: `g`", True),
+                message("src/lib.rs", 9, "note: #[warn(unused_variables)] on by default", True),
             ]
         )
 
+    def test_stream_build_output(self):
+        lines = iter([
+            '{"reason":"compiler-artifact","fresh":false}',
+            '{"message":{"code":null,"level":"error","message":"mismatched types","spans":[{"column_start":18,"expansion":null,"file_name":"src/lib.rs","label":"expected `i32`, found `&str`","line_start":6}]},"reason":"compiler-message"}',
+            'not json',
+        ])
+        batches = parse.iter_command_output("build", lines, path_transformer)
+
+        batch = next(batches)
+        self.assertEqual(
+            [ m.render() for m in parse.flatten(batch) ],
+            [
+                message("src/lib.rs", 6, "mismatched types", column=18),
+                message("src/lib.rs", 6, "expected `i32`, found `&str`", column=18),
+            ]
+        )
+        self.assertEqual(list(batches), [])
+
+    def test_primary_span(self):
+        record = {
+            "reason": "compiler-message",
+            "message": {
+                "code": {"code": "E0499"},
+                "level": "error",
+                "message": "cannot borrow `v` as mutable more than once at a time",
+                "spans": [
+                    {"file_name": "src/lib.rs", "line_start": 3, "column_start": 13, "is_primary": False, "label": "first mutable borrow occurs here", "expansion": None},
+                    {"file_name": "src/lib.rs", "line_start": 4, "column_start": 13, "is_primary": True, "label": "second mutable borrow occurs here", "expansion": None},
+                    {"file_name": "src/lib.rs", "line_start": 5, "column_start": 5, "is_primary": False, "label": "first borrow later used here", "expansion": None},
+                ],
+                "children": [
+                    {"level": "note", "message": "borrows are checked per function", "spans": []},
+                    {"level": "help", "message": "consider cloning", "spans": [
+                        {"file_name": "src/lib.rs", "line_start": 3, "column_start": 18, "is_primary": True, "label": None, "expansion": None},
+                    ]},
+                ],
+            },
+        }
+        m = parse._compiler_message(record, path_transformer)
+        self.assertEqual(m.code, "E0499")
+        self.assertEqual((m.line, m.column), (4, 13))
+        self.assertEqual(
+            [ c.render() for c in parse.flatten([m]) ],
+            [
+                message("src/lib.rs", 4, "cannot borrow `v` as mutable more than once at a time"),
+                message("src/lib.rs", 4, "second mutable borrow occurs here"),
+                message("src/lib.rs", 3, "first mutable borrow occurs here"),
+                message("src/lib.rs", 5, "first borrow later used here"),
+                message("src/lib.rs", 4, "note: borrows are checked per function"),
+                message("src/lib.rs", 3, "help: consider cloning"),
+            ]
+        )
+
+    def test_stream_test_output_reason_last(self):
+        lines = iter([
+            '{"fresh":false,"reason":"compiler-artifact"}',
+            '{"message":{"code":null,"level":"error","message":"cannot find value `x` in this scope","spans":[{"column_start":9,"expansion":null,"file_name":"src/lib.rs","is_primary":true,"label":null,"line_start":4}]},"reason":"compiler-message"}',
+            '{"success":false,"reason":"build-finished"}',
+        ])
+        batches = parse.iter_command_output("test", lines, path_transformer)
+
+        self.assertEqual(
+            [ [ m.render() for m in batch ] for batch in batches ],
+            [ [ message("src/lib.rs", 4, "cannot find value `x` in this scope", column=9) ] ]
+        )
+
     def test_deduplicate(self):
         messages = [
-                message("filename", 100, "hello world"),
-                message("filename", 100, "hello world"),
-                message("yet another message", 100, "hello world"),
-                message("filename", 101, "hello world")
+                message_object("filename", 100, "hello world"),
+                message_object("filename", 100, "hello world"),
+                message_object("yet another message", 100, "hello world"),
+                message_object("filename", 101, "hello world"),
+                message_object("filename", 101, "hello world", column=5),
+                message_object("filename", 101, "hello world", warning=True),
         ]
 
         expected_messages = [
                 message("filename", 100, "hello world"),
                 message("yet another message", 100, "hello world"),
-                message("filename", 101, "hello world")
+                message("filename", 101, "hello world"),
+                message("filename", 101, "hello world", column=5),
+                message("filename", 101, "hello world", warning=True),
         ]
 
-        self.assertItemsEqual(
-                parse._deduplicate_messages(messages),
+        self.assertEqual(
+                [ m.render() for m in parse._deduplicate_messages(messages) ],
                 expected_messages,
         )
 
+    def test_deduplicate_across_levels(self):
+        deduplicator = parse.Deduplicator(merge_levels=True)
+
+        self.assertTrue(deduplicator.add(message_object("filename", 100, "hello world")))
+        self.assertFalse(deduplicator.add(message_object("filename", 100, "hello world", warning=True)))
+
     def test_cargo_test(self):
         stdout = """
 
@@ -130,10 +226,59 @@ note: Run with `RUST_BACKTRACE=1` for a backtrace.
         self.assertItemsEqual(
             [ m.render() for m in errors ],
             [
-                message("src/lib.rs", 479, "tests::find_a_key assertion failed: `(left == right)` left: `None`, right: `Some(500)`", column=8),
-                message("src/lib.rs", 502, "tests::find_a_block assertion failed: `(left == right)` left: `None`, right: `Some(123)`", column=8),
+                message("src/lib.rs", 479, "tests::find_a_key assertion failed: `(left == right)` left: `None`, right: `Some(500)`", column=8, test="tests::find_a_key"),
+                message("src/lib.rs", 502, "tests::find_a_block assertion failed: `(left == right)` left: `None`, right: `Some(123)`", column=8, test="tests::find_a_block"),
+            ]
+        )
+
+    def test_cargo_test_panic_location_first(self):
+        stdout = """
+---- tests::it_fails stdout ----
+
+thread 'tests::it_fails' panicked at src/lib.rs:11:9:
+assertion `left == right` failed
+  left: 2
+ right: 3
+note: run with `RUST_BACKTRACE=1` environment variable to display a backtrace
+
+---- tests::it_errs stdout ----
+Error: "not found"
+
+failures:
+    tests::it_fails
+    tests::it_errs
+"""
+        errors = parse.parse_test_output(stdout, path_transformer)
+        self.assertEqual(
+            [ m.render() for m in errors ],
+            [
+                message("src/lib.rs", 11, "tests::it_fails assertion `left == right` failed left: 2 right: 3", test="tests::it_fails"),
+                message("", 0, "tests::it_errs Error: \"not found\"", test="tests::it_errs"),
             ]
         )
+        self.assertEqual(errors[0].column, 9)
+
+    def test_libtest_json(self):
+        lines = [
+            '{"reason":"build-finished","success":true}',
+            '{ "type": "suite", "event": "started", "test_count": 2 }',
+            '{ "type": "test", "event": "started", "name": "tests::it_panics" }',
+            '{ "type": "test", "name": "tests::it_panics", "event": "failed", "stdout": "\\nthread \'tests::it_panics\' panicked at src/lib.rs:16:9:\\nmulti\\nline message\\nstack backtrace:\\n" }',
+            '{ "type": "test", "name": "tests::it_works", "event": "ok" }',
+        ]
+        batches = list(parse.iter_command_output("test", iter(lines), path_transformer))
+        self.assertEqual(
+            [ [ m.render() for m in batch ] for batch in batches ],
+            [ [ message("src/lib.rs", 16, "tests::it_panics multi line message", test="tests::it_panics") ] ]
+        )
+
+        # A targeted run records where the tests were run, but only on the
+        # test failures.
+        compile_error = message_object("src/lib.rs", 3, "mismatched types")
+        batch = batches[0] + [compile_error]
+        parse.set_test_target(batch, cargo._test_target("/p", ["--lib"]))
+        self.assertEqual(batch[0].render()["test"], {"name": "tests::it_panics", "target": "/p --lib"})
+        self.assertNotIn("test", compile_error.render())
 
     def test_relative_paths(self):
         self.assertEqual(
@@ -145,6 +290,46 @@ note: Run with `RUST_BACKTRACE=1` for a backtrace.
                 "sstable/src/lib.rs"
         )
 
+    def test_absolute_paths(self):
+        self.assertEqual(
+                parse.transform_relative_path(
+                    "/Users/colinmerkel/Documents/rust/flags/src/parse.rs",
+                    "/Users/colinmerkel/Documents/rust/flagger",
+                    "/Users/colinmerkel/Documents/rust/flagger",
+                ),
+                "../flags/src/parse.rs"
+        )
+
+    def test_macro_expansion_chain(self):
+        def span(file_name, line, expansion=None):
+            return {
+                "file_name": file_name,
+                "line_start": line,
+                "column_start": 5,
+                "label": None,
+                "expansion": expansion and {"span": expansion},
+            }
+
+        user = span("src/lib.rs", 12)
+        inner = span("<::core::macros::assert_eq macros>", 3, user)
+        outer = span("/rustc/library/core/src/macros/mod.rs", 40, inner)
+        line = json.dumps({
+            "reason": "compiler-message",
+            "message": {"message": "mismatched types", "level": "error", "code": None, "spans": [outer]},
+        })
+
+        transformed = []
+        def transformer(path):
+            transformed.append(path)
+            return "crate/" + path
+
+        errors, _ = parse.parse_build_output("\n".join([line, line]), transformer)
+        self.assertEqual(
+            [ m.render() for m in errors ],
+            [ message("crate/src/lib.rs", 12, "mismatched types") ] * 2
+        )
+        self.assertEqual(transformed, ["src/lib.rs"])
+
     def test_error_parsing(self):
         stdout = """
 error[E0425]: cannot find value `asdf1` in this scope
@@ -224,6 +409,620 @@ help: the following trait is implemented but not in scope, perhaps add a `use` f
                 message("util/ws/main.rs", 7, " |  use ws::Server;", column=25)
             ]
         )
+    def test_bazel_warnings(self):
+        stdout = """
+warning: unused variable: `x`
+ --> util/ws/main.rs:3:9
+  |
+3 |     let x = 5;
+  |         ^ help: if this is intentional, prefix it with an underscore: `_x`
+  |
+  = note: `#[warn(unused_variables)]` on by default
+
+error: aborting due to previous error
+error[E0425]: cannot find value `y` in this scope
+ --> util/ws/main.rs:4:5
+"""
+        messages = parse.parse_bazel_build_output(stdout, path_transformer)
+
+        self.assertEqual(
+            [ m.render() for m in messages ],
+            [
+                message("util/ws/main.rs", 3, "unused variable: `x`", True),
+                message("util/ws/main.rs", 3, " |      let x = 5;", True),
+                message("util/ws/main.rs", 3, " |          ^ help: if this is intentional, prefix it with an underscore: `_x`", True),
+                message("util/ws/main.rs", 3, "`#[warn(unused_variables)]` on by default", True),
+                message("util/ws/main.rs", 4, "cannot find value `y` in this scope"),
+            ]
+        )
+
+    def test_bazel_message_tree(self):
+        stdout = """
+error[E0599]: no method named `serve` found for type `server::ReviewServer` in the current scope
+ --> util/ws/main.rs:7:33
+  |
+7 |     server::ReviewServer::new().serve(8080);
+  |                                 ^^^^^
+  |
+  = help: items from traits can only be used if the trait is in scope
+"""
+        errors, warnings = parse.parse_bazel_output("build", stdout, path_transformer)
+
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(
+            [ m.text for m in errors[0].children ],
+            [
+                " |      server::ReviewServer::new().serve(8080);",
+                " |                                  ^^^^^",
+                "items from traits can only be used if the trait is in scope",
+            ]
+        )
+        self.assertTrue(errors[0].children[0].parent is errors[0])
+        self.assertTrue(errors[0].children[0].filename is errors[0].filename)
+
+    def test_bazel_build_events(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        test_log = os.path.join(directory, "test.log")
+        with open(test_log, "w") as f:
+            f.write("""
+running 2 tests
+test tests::it_works ... FAILED
+test tests::other ... ok
+
+failures:
+
+---- tests::it_works stdout ----
+thread 'tests::it_works' panicked at util/ws/lib.rs:12:9:
+assertion failed: false
+
+test result: FAILED. 1 passed; 1 failed; 0 ignored; 0 measured
+""")
+
+        # Recorded from `bazel test --build_event_json_file`, trimmed to the
+        # events that matter and with the paths made up.
+        events = [
+            {"id": {"started": {}}, "started": {"command": "test"}},
+            {"id": {"progress": {}}, "progress": {"stderr": "ERROR: util/ws/BUILD.bazel:4:8: no such target '//util/ws:missing'\nerror[E0425]: cannot find value `y` in this scope\n --> util/ws/main.rs:4:20\n"}},
+            {"id": {"progress": {"opaqueCount": 1}}, "progress": {"stderr": "  |\n4 |     println!(\"{}\", y);\n  |                    ^ not found in this scope\n\n"}},
+            {"id": {"actionCompleted": {"label": "//util/ws:bin"}}, "action": {"success": False, "label": "//util/ws:bin", "type": "Rustc", "exitCode": 1}},
+            {"id": {"testResult": {"label": "//util/ws:lib_test", "run": 1, "shard": 1, "attempt": 1}}, "testResult": {"status": "FAILED", "testAttemptDurationMillis": "350", "testActionOutput": [{"name": "test.log", "uri": "file://" + test_log}]}},
+            {"id": {"testResult": {"label": "//util/ws:other_test", "run": 1, "shard": 1, "attempt": 1}}, "testResult": {"status": "PASSED", "testActionOutput": [{"name": "test.log", "uri": "file:///does/not/exist"}]}},
+            {"id": {"testResult": {"label": "//util/ws:slow_test", "run": 1, "shard": 1, "attempt": 1}}, "testResult": {"status": "TIMEOUT", "testAttemptDurationMillis": "300000"}},
+            {"id": {"targetCompleted": {"label": "//util/bad:lib"}}, "aborted": {"reason": "ANALYSIS_FAILURE", "description": "Analysis of target '//util/bad:lib' failed"}},
+            {"id": {"targetCompleted": {"label": "//util/ws:dep"}}, "aborted": {"reason": "SKIPPED"}},
+        ]
+        lines = [json.dumps(e) for e in events] + ['{"id": {"progress"']
+
+        def label_path(label):
+            return label[2:].split(":")[0] + "/BUILD"
+
+        messages = [m for batch in parse.iter_build_events(parse.decode_events(lines), path_transformer, label_path) for m in batch]
+        self.assertEqual(
+            [ (m.filename, m.line, m.text) for m in messages ],
+            [
+                ("util/ws/BUILD.bazel", 4, "no such target '//util/ws:missing'"),
+                ("util/ws/main.rs", 4, "cannot find value `y` in this scope"),
+                ("util/ws/BUILD", 0, "//util/ws:bin: Rustc failed (exit code 1)"),
+                ("util/ws/lib.rs", 12, "tests::it_works assertion failed: false"),
+                ("util/ws/BUILD", 0, "//util/ws:slow_test: TIMEOUT in 300.0s"),
+                ("util/bad/BUILD", 0, "//util/bad:lib: Analysis of target '//util/bad:lib' failed"),
+            ]
+        )
+
+
+class TestRoots(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        roots._cache = roots.RootCache(os.path.join(self.directory, "roots.json"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, path, text=""):
+        path = os.path.join(self.directory, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write(text)
+        return path
+
+    def test_cargo_workspace(self):
+        self.write("Cargo.toml", "[workspace]\nmembers = [\"member\"]\n")
+        self.write("member/Cargo.toml", "[package]\nname = \"member\"\n")
+        source = self.write("member/src/lib.rs")
+
+        self.assertEqual(
+            roots.find_cargo_dirs(source),
+            (os.path.join(self.directory, "member"), self.directory)
+        )
+
+    def test_cached_root_is_checked_against_marker(self):
+        manifest = self.write("Cargo.toml", "[package]\n")
+        source = self.write("src/lib.rs")
+        self.assertEqual(
+            roots.find_cargo_dirs(source),
+            (self.directory, self.directory)
+        )
+
+        # Loading the cache from disk again finds the same root.
+        roots._cache = roots.RootCache(roots._cache.path)
+        self.assertEqual(
+            roots.find_cargo_dirs(source),
+            (self.directory, self.directory)
+        )
+
+        os.remove(manifest)
+        self.assertEqual(roots.find_cargo_dirs(source), None)
+
+    def test_cargo_target(self):
+        def target(kind, name, path):
+            return {"kind": [kind], "name": name, "src_path": os.path.join("/ws/src", path)}
+        targets = [
+            target("lib", "demo", "lib.rs"),
+            target("bin", "demo", "main.rs"),
+            target("bin", "tool", "bin/tool/main.rs"),
+            target("custom-build", "build-script-build", "../build.rs"),
+        ]
+
+        self.assertEqual(roots.cargo_target("/ws/src/lib.rs", targets), ["--lib"])
+        self.assertEqual(roots.cargo_target("/ws/src/bin/tool/args.rs", targets), ["--bin", "tool"])
+        # Both the library and the main binary could have this module.
+        self.assertEqual(roots.cargo_target("/ws/src/util.rs", targets), None)
+        self.assertEqual(roots.cargo_target("/ws/src/util.rs", targets[:1]), ["--lib"])
+        self.assertEqual(roots.cargo_target("/ws/build.rs", targets), None)
+
+    def test_cargo_package(self):
+        self.write("Cargo.toml", "[workspace]\nmembers = [\"member\", \"member/nested\"]\n")
+        source = self.write("member/nested/src/lib.rs")
+        roots._metadata_cache(self.directory).put(roots.METADATA_KEY + self.directory, [
+            {"name": "member", "dir": os.path.join(self.directory, "member"), "edition": "2018", "path_dependencies": [], "targets": []},
+            {"name": "nested", "dir": os.path.join(self.directory, "member/nested"), "edition": "2021", "path_dependencies": [], "targets": [
+                {"kind": ["lib"], "name": "nested", "src_path": source},
+            ]},
+        ], [os.path.join(self.directory, "Cargo.toml")])
+
+        self.assertEqual(roots.find_cargo_package(source, self.directory), ("nested", ["--lib"]))
+        self.assertEqual(roots.find_cargo_package(os.path.join(self.directory, "build.rs"), self.directory), None)
+        self.assertEqual(roots.cargo_edition(source, self.directory), "2021")
+
+    def test_cache_is_bounded(self):
+        manifest = self.write("Cargo.toml", "[package]\n")
+        max_entries = roots.MAX_ENTRIES
+        roots.MAX_ENTRIES = 3
+        try:
+            for i in range(5):
+                roots._cache.put("key%d" % i, i, [manifest])
+        finally:
+            roots.MAX_ENTRIES = max_entries
+        self.assertEqual(sorted(roots._cache.entries), ["key2", "key3", "key4"])
+
+        # The packages of a workspace are kept apart from the roots.
+        roots._metadata_cache(self.directory).put(roots.METADATA_KEY + self.directory, [], [manifest])
+        self.assertEqual(sorted(store.load(roots._cache.path, {})), ["key2", "key3", "key4"])
+
+    def test_unknown_target(self):
+        package = {"name": "demo", "dir": "/ws", "targets": [
+            {"kind": ["lib"], "name": "demo", "src_path": "/ws/src/lib.rs"},
+            {"kind": ["bin"], "name": "tool", "src_path": "/ws/src/bin/tool.rs"},
+        ]}
+        self.assertFalse(roots._unknown_target("/ws/src/lib.rs", package))
+        self.assertFalse(roots._unknown_target("/ws/src/util.rs", package))
+        self.assertFalse(roots._unknown_target("/ws/src/bin/tool.rs", package))
+        # cargo would find these without a change to the manifest.
+        self.assertTrue(roots._unknown_target("/ws/src/main.rs", package))
+        self.assertTrue(roots._unknown_target("/ws/src/bin/other.rs", package))
+        self.assertTrue(roots._unknown_target("/ws/src/bin/other/main.rs", package))
+        self.assertTrue(roots._unknown_target("/ws/tests/it.rs", package))
+        self.assertFalse(roots._unknown_target("/ws/src/bin/other/args.rs", package))
+
+    def test_metadata_failure_is_not_cached(self):
+        self.write("Cargo.toml", "[package\n")
+        self.assertEqual(roots.cargo_metadata(self.directory), [])
+        self.assertEqual(roots._metadata_cache(self.directory).get(roots.METADATA_KEY + self.directory), None)
+
+    def test_rustfmt_config(self):
+        config = self.write(".rustfmt.toml")
+        self.write("member/Cargo.toml", "[package]\n")
+        member = os.path.join(self.directory, "member")
+        self.assertEqual(roots.find_rustfmt_config(member), config)
+
+        # A config in the package is found once the old one has gone.
+        member_config = self.write("member/rustfmt.toml")
+        self.assertEqual(roots.find_rustfmt_config(member), config)
+        os.remove(config)
+        self.assertEqual(roots.find_rustfmt_config(member), member_config)
+
+    def test_bazel_markers(self):
+        self.write("MODULE.bazel")
+        self.write("pkg/BUILD")
+
+        self.assertEqual(
+            roots.find_bazel_dir(os.path.join(self.directory, "pkg")),
+            self.directory
+        )
+
+class TestSnapshots(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        snapshots._snapshots = snapshots.Snapshots(os.path.join(self.directory, "snapshots.json"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_diff(self):
+        first = message_object("src/lib.rs", 1, "first")
+        second = message_object("src/lib.rs", 2, "second")
+        third = message_object("src/lib.rs", 3, "third")
+
+        diff = snapshots.Diff("cargo build", None)
+        self.assertEqual(diff.added([first, second]), [first, second])
+        snapshot = diff.finish()
+        self.assertTrue(snapshot["reset"])
+
+        diff = snapshots.Diff("cargo build", snapshot["snapshot"])
+        self.assertEqual(diff.added([second, third]), [third])
+        self.assertEqual(
+            diff.finish()["removed"],
+            [first.digest()]
+        )
+
+        # An old snapshot can't be patched anymore.
+        diff = snapshots.Diff("cargo build", snapshot["snapshot"])
+        self.assertTrue(diff.reset)
+
+class TestBuilds(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        builds._builds = builds.Builds(os.path.join(self.directory, "builds"))
+        builds._large = roots.RootCache(os.path.join(self.directory, "large.json"))
+        self.tree = os.path.join(self.directory, "tree")
+        os.makedirs(os.path.join(self.tree, "target"))
+        with open(os.path.join(self.tree, "lib.rs"), "w") as f:
+            f.write("fn main() {}")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_replay(self):
+        m = message_object("src/lib.rs", 6, "mismatched types", column=18)
+        m.code = "E0308"
+        m.child("expected `i32`, found `&str`")
+
+        build = builds.Build([self.tree], ["cargo", "build"])
+        self.assertEqual(build.cached(), None)
+        build.add([m])
+        build.finish(1)
+
+        cached = builds.Build([self.tree], ["cargo", "build"]).cached()
+        self.assertEqual(cached, [m])
+        self.assertEqual(cached[0].digest(), m.digest())
+        self.assertEqual(cached[0].children[0].parent, cached[0])
+
+        # Build outputs don't matter, but the sources do.
+        with open(os.path.join(self.tree, "target", "out"), "w") as f:
+            f.write("output")
+        self.assertEqual(builds.Build([self.tree], ["cargo", "build"]).cached(), [m])
+        with open(os.path.join(self.tree, "lib.rs"), "w") as f:
+            f.write("fn main() { }")
+        self.assertEqual(builds.Build([self.tree], ["cargo", "build"]).cached(), None)
+
+    def test_unexplained_failure_is_not_cached(self):
+        warning = message_object("src/lib.rs", 1, "unused", True)
+        build = builds.Build([self.tree], ["cargo", "build"])
+        build.add([warning])
+        build.finish(101)
+        self.assertEqual(builds.Build([self.tree], ["cargo", "build"]).cached(), None)
+        build.finish(0)
+        self.assertEqual(builds.Build([self.tree], ["cargo", "build"]).cached(), [warning])
+
+    def test_large_tree(self):
+        max_files = builds.MAX_FILES
+        builds.MAX_FILES = 1
+        try:
+            with open(os.path.join(self.tree, "main.rs"), "w") as f:
+                f.write("fn main() {}")
+            self.assertEqual(builds.fingerprint([self.tree], []), None)
+            # It isn't gone over again until the tree changes.
+            self.assertTrue(builds._large.get(self.tree))
+            os.remove(os.path.join(self.tree, "main.rs"))
+            self.assertEqual(builds._large.get(self.tree), None)
+            self.assertNotEqual(builds.fingerprint([self.tree], []), None)
+        finally:
+            builds.MAX_FILES = max_files
+
+    def test_cargo_inputs(self):
+        def write(path, text):
+            with open(path, "w") as f:
+                f.write(text)
+        dep = os.path.join(self.directory, "dep")
+        os.makedirs(dep)
+        write(os.path.join(dep, "lib.rs"), "pub fn f() {}")
+        write(os.path.join(self.tree, "Cargo.toml"), "[package]\n")
+        toolchain_file = os.path.join(self.tree, "rust-toolchain.toml")
+        write(toolchain_file, "[toolchain]\n")
+        roots._cache = roots.RootCache(os.path.join(self.directory, "roots.json"))
+        roots._metadata_cache(self.tree).put(roots.METADATA_KEY + self.tree, [
+            {"name": "tree", "dir": self.tree, "edition": "2021", "path_dependencies": [dep], "targets": []},
+        ], [os.path.join(self.tree, "Cargo.toml")])
+
+        paths, extra = builds.cargo_inputs(self.tree)
+        self.assertIn(dep, paths)
+        self.assertIn(toolchain_file, paths)
+        key = builds.Build(paths, extra).key
+
+        # A path dependency outside of the workspace is part of the build.
+        write(os.path.join(dep, "lib.rs"), "pub fn f() { }")
+        self.assertNotEqual(builds.Build(*builds.cargo_inputs(self.tree)).key, key)
+        key = builds.Build(*builds.cargo_inputs(self.tree)).key
+
+        # And so is the environment.
+        rustflags = os.environ.get("RUSTFLAGS")
+        os.environ["RUSTFLAGS"] = (rustflags or "") + " -Dwarnings"
+        try:
+            self.assertNotEqual(builds.Build(*builds.cargo_inputs(self.tree)).key, key)
+        finally:
+            if rustflags is None:
+                del os.environ["RUSTFLAGS"]
+            else:
+                os.environ["RUSTFLAGS"] = rustflags
+
+    def test_eviction(self):
+        keys = []
+        for i in range(builds.MAX_BUILDS + 1):
+            # Using the first build keeps it from being evicted.
+            if i == builds.MAX_BUILDS:
+                builds._builds.get(keys[0])
+            build = builds.Build([self.tree], ["cargo", "build", str(i)])
+            build.finish(0)
+            keys.append(build.key)
+
+        self.assertEqual(len(builds._builds.index), builds.MAX_BUILDS)
+        self.assertTrue(keys[0] in builds._builds.index)
+        self.assertTrue(keys[1] not in builds._builds.index)
+
+class TestCargo(unittest.TestCase):
+    def test_test_args(self):
+        tests = {"path": ["tests", "it_works"], "exact": 1}
+        self.assertEqual(
+            cargo.test_args("/p/src/lib.rs", "/p", tests),
+            (["--lib"], "tests::it_works", True)
+        )
+        self.assertEqual(
+            cargo.test_args("/p/src/a/mod.rs", "/p", {"path": ["tests"]}),
+            ([], "a::tests", False)
+        )
+        self.assertEqual(
+            cargo.test_args("/p/src/a/b.rs", "/p", {"path": []}),
+            ([], "a::b", False)
+        )
+        self.assertEqual(
+            cargo.test_args("/p/tests/integration.rs", "/p", {"path": [], "exact": 0}),
+            (["--test", "integration"], "", False)
+        )
+
+class TestResults(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        snapshots._snapshots = snapshots.Snapshots(os.path.join(self.directory, "snapshots.json"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_message_limit(self):
+        collector = results.Collector("bazel build", {"max_messages": 2})
+        collector.add([message_object("src/lib.rs", 1, "first")])
+        self.assertFalse(collector.full())
+        collector.add([message_object("src/lib.rs", i, "more") for i in range(2, 5)])
+        self.assertTrue(collector.full())
+        collector.stop()
+
+        response = collector.finish("bazel", "build")
+        self.assertEqual(len(response["quickfix"]), 4)
+        self.assertTrue(response["message"].endswith("(stopped after 2 errors)"))
+
+    def test_warnings_dont_hide_errors(self):
+        collector = results.Collector("cargo build", {"max_messages": 3})
+        collector.add([message_object("src/lib.rs", i, "unused", True) for i in range(1, 6)])
+        self.assertFalse(collector.full())
+        collector.add([message_object("src/lib.rs", 6, "mismatched types")])
+
+        response = collector.finish("cargo", "build")
+        self.assertEqual(response["message"], "`cargo build` failed, check quickfix")
+        self.assertEqual([e["text"] for e in response["quickfix"]], ["mismatched types"])
+        self.assertEqual(len(collector.warnings), 3)
+
+    def test_stream_drops_warnings_after_error(self):
+        sent = []
+        collector = results.Collector("cargo build", {}, sent.append)
+        warning = message_object("src/lib.rs", 1, "unused", True)
+        collector.add([warning])
+        time.sleep(results.EMIT_INTERVAL * 2)
+        collector.add([message_object("src/lib.rs", 2, "mismatched types")])
+        collector.add([message_object("src/lib.rs", 3, "unused too", True)])
+        response = collector.finish("cargo", "build")
+
+        # As without streaming, only the error is left in the list.
+        texts = [e["text"] for r in sent for e in r["quickfix"]]
+        self.assertEqual(texts, ["unused", "mismatched types"])
+        self.assertEqual(response["removed"], [warning.digest()])
+        self.assertEqual(response["message"], "`cargo build` failed, check quickfix")
+
+    def test_emit_batches(self):
+        sent = []
+        collector = results.Collector("cargo build", {"tests": {}}, sent.append)
+        for i in range(1, 4):
+            collector.add([message_object("src/lib.rs", i, "message")])
+        # The first message is sent right away, and the ones right after it
+        # are held back until the interval has passed.
+        self.assertEqual([len(r["quickfix"]) for r in sent], [1])
+        time.sleep(results.EMIT_INTERVAL * 2)
+        self.assertEqual([len(r["quickfix"]) for r in sent], [1, 2])
+
+        # The held back ones went out about an interval after the first.
+        time.sleep(results.EMIT_INTERVAL * 2)
+        collector.add([message_object("src/lib.rs", 4, "message")])
+        collector.add([message_object("src/lib.rs", 5, "message")])
+        collector.finish("cargo", "build")
+        self.assertEqual([len(r["quickfix"]) for r in sent], [1, 2, 1, 1])
+
+class TestJobs(unittest.TestCase):
+    def test_parallel(self):
+        self.assertEqual(
+            jobs.parallel([lambda i=i: i * i for i in range(10)], 3),
+            [i * i for i in range(10)]
+        )
+
+    def test_close_stops_command(self):
+        job = jobs.Job()
+        lines = job.lines(["yes"], None)
+        self.assertEqual([next(lines) for _ in range(3)], ["y\n"] * 3)
+        lines.close()
+        self.assertNotEqual(job.processes[0].poll(), None)
+
+    def test_follow(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "events.json")
+
+        job = jobs.Job()
+        process = job.start(["sh", "-c", "sleep 0.2; printf 'a\\nb' > %s; sleep 0.2; printf '\\nc\\n' >> %s" % (path, path)], None)
+        self.assertEqual(list(jobs.follow(path, process, 0.01)), ["a", "b", "c"])
+
+    def test_lines_status(self):
+        job = jobs.Job()
+        status = {}
+        self.assertEqual(list(job.lines(["sh", "-c", "echo a; exit 3"], None, status)), ["a\n"])
+        self.assertEqual(status["returncode"], 3)
+
+    def test_communicate(self):
+        job = jobs.Job()
+        self.assertEqual(job.communicate(["sh", "-c", "tr a b; echo oops >&2; exit 3"], None, "aaa\n"), (3, "bbb\n", "oops\n"))
+        job.cancel()
+        self.assertEqual(job.communicate(["cat"], None, ""), None)
+
+    def test_parallel_error(self):
+        def fail():
+            raise parse.CargoParseError("failed")
+
+        with self.assertRaises(parse.CargoParseError):
+            jobs.parallel([lambda: 1, fail, lambda: 2], 2)
+
+class TestStats(unittest.TestCase):
+    def test_nested_phases(self):
+        recorder = stats.Stats()
+        def lines():
+            time.sleep(0.05)
+            yield "line"
+        with recorder.phase("parse"):
+            self.assertEqual(list(recorder.lines(lines())), ["line"])
+
+        run = recorder.finish()
+        self.assertGreaterEqual(run["phases"]["command"]["wall"], 0.05)
+        # The time spent reading the lines isn't counted as parsing.
+        self.assertLess(run["phases"]["parse"]["wall"], 0.05)
+        self.assertEqual(run["counts"], {"lines": 1, "bytes": 4})
+
+    def test_last(self):
+        runs = [json.dumps({"tool": "cargo", "command": "build", "wall": i}) for i in range(5)]
+        self.assertEqual(
+            [r["wall"] for r in stats.last(runs[:3] + ["{"] + runs[3:], 2)],
+            [3, 4]
+        )
+
+
+class TestRustfmt(unittest.TestCase):
+    def test_changed_lines(self):
+        previous = ["a", "b", "c", "d", "e", "f"]
+        self.assertEqual(rustfmt.changed_lines(previous, previous), [])
+        self.assertEqual(rustfmt.changed_lines(previous, ["a", "B", "c", "d", "x", "y", "e", "f"]), [[2, 2], [5, 6]])
+        # Deleted lines count as a change to the line after them.
+        self.assertEqual(rustfmt.changed_lines(previous, ["a", "b", "e", "f"]), [[3, 3]])
+        self.assertEqual(rustfmt.changed_lines(previous, ["a", "b", "C", "e", "f"]), [[3, 3]])
+        self.assertEqual(rustfmt.changed_lines(previous, ["a", "b", "c", "d", "e"]), [[5, 5]])
+        self.assertEqual(rustfmt.changed_lines(previous, []), [])
+
+    def test_edits(self):
+        text = ["fn a(){}", "", "fn b() {", "    let x=1;", "}"]
+        formatted = ["fn a() {}", "", "fn b() {", "    let x = 1;", "}"]
+        self.assertEqual(rustfmt.edits(text, formatted), [[0, 1, ["fn a() {}"]], [3, 4, ["    let x = 1;"]]])
+        # Only the changes to the lines that were edited are kept.
+        self.assertEqual(rustfmt.edits(text, formatted, [[4, 5]]), [[3, 4, ["    let x = 1;"]]])
+        self.assertEqual(rustfmt.edits(text, text), [])
+
+        # Joined lines are replaced as a whole.
+        self.assertEqual(
+            rustfmt.edits(["f(", "    a,", ")", "g()"], ["f(a)", "g()"], [[2, 2]]),
+            [[0, 3, ["f(a)"]]]
+        )
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.started = []
+        self.output = []
+        self.release = threading.Event()
+        def run(command, file_path, cwd, emit, job, options):
+            self.started.append(command)
+            while not job.cancelled and not self.release.is_set():
+                time.sleep(0.01)
+            if job.cancelled:
+                return results.result("`fake %s` was cancelled" % command)
+            return results.result(command)
+        self.tools = server.TOOLS
+        server.TOOLS = {"fake": run}
+
+        class Output(object):
+            def write(output, line):
+                self.output.append(json.loads(line))
+            def flush(output):
+                pass
+        self.server = server.Server(Output())
+
+    def tearDown(self):
+        server.TOOLS = self.tools
+
+    def request(self, request_id, command, priority="interactive", cwd="/a"):
+        self.server.handle({"id": request_id, "method": "run", "tool": "fake",
+            "command": command, "file": "lib.rs", "cwd": cwd, "priority": priority})
+
+    def wait(self, count):
+        for _ in range(200):
+            if len(self.output) >= count:
+                break
+            time.sleep(0.01)
+        return [(r["id"], r["message"]) for r in self.output]
+
+    def test_queue(self):
+        self.request(1, "build")
+        self.request(2, "check", "background")
+        self.request(3, "test")
+        # The same as a waiting request replaces it, and goes ahead of the
+        # background check.
+        self.request(4, "test")
+        self.assertEqual(self.wait(1), [(3, "`fake test` was cancelled")])
+        self.release.set()
+        self.wait(4)
+        self.assertEqual(self.started, ["build", "test", "check"])
+        self.assertEqual([r["id"] for r in self.output], [3, 1, 4, 2])
+
+    def test_background_is_cancelled(self):
+        self.request(1, "check", "background")
+        self.request(2, "build")
+        self.assertEqual(self.wait(1), [(1, "`fake check` was cancelled")])
+        self.release.set()
+        self.assertEqual(self.wait(2)[1], (2, "build"))
+        self.assertEqual(self.started, ["check", "build"])
+
+    def test_roots_run_in_parallel(self):
+        self.request(1, "build", cwd="/a")
+        self.request(2, "build", cwd="/b")
+        for _ in range(100):
+            if len(self.started) == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.started, ["build", "build"])
+        self.release.set()
+        self.assertEqual(sorted(self.wait(2)), [(1, "build"), (2, "build")])
 
 
 if __name__ == '__main__':